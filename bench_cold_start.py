@@ -0,0 +1,79 @@
+# Copyright (c) 2017 Sandtable Ltd. All rights reserved.
+
+"""
+Cold start benchmark of lambda_function.py.
+
+Each sample runs in a fresh interpreter, which imports the module and
+answers a GetInstanceTypes question, the only intent that never calls AWS.
+
+Usage: python bench_cold_start.py [--samples 20] [--max-import-ms 150]
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SAMPLE = '''
+import json, time
+started = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+lambda_function.lambda_handler({
+    'userId': 'bench', 'bot': {'name': 'Sbot'}, 'sessionAttributes': None,
+    'invocationSource': 'FulfillmentCodeHook',
+    'currentIntent': {'name': 'GetInstanceTypes',
+                      'slots': {'CPUs': '4', 'Memory': '16 GB'}}}, None)
+answered = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_response_ms': (answered - imported) * 1000,
+    'setup_ms': lambda_function.INIT_STATS['setup_ms'],
+    'modules': [name for name in ('boto3', 'numpy')
+                if name in __import__('sys').modules]}))
+'''
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def run_sample():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output([sys.executable, '-c', SAMPLE],
+                                     cwd=directory,
+                                     stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--samples', type=int, default=20)
+    parser.add_argument('--max-import-ms', type=float,
+                        help='fail if the median import time is above it')
+    args = parser.parse_args()
+
+    samples = [run_sample() for _ in range(args.samples)]
+
+    for metric in ('import_ms', 'setup_ms', 'first_response_ms'):
+        values = [sample[metric] for sample in samples]
+        print('{:<18} p50 {:8.2f}  p95 {:8.2f}  max {:8.2f}'.format(
+            metric, percentile(values, 50), percentile(values, 95),
+            max(values)))
+    heavy = sorted(set(name for sample in samples
+                       for name in sample['modules']))
+    print('heavy modules loaded: {}'.format(', '.join(heavy) or 'none'))
+
+    median = percentile([sample['import_ms'] for sample in samples], 50)
+    if args.max_import_ms is not None and median > args.max_import_ms:
+        print('Median import time {:.2f} ms is above {:.2f} ms'.format(
+            median, args.max_import_ms))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
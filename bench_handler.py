@@ -0,0 +1,252 @@
+# Copyright (c) 2017 Sandtable Ltd. All rights reserved.
+
+"""
+Offline latency benchmark of lambda_handler.
+
+Replays a corpus of Lex events (every intent, both invocation sources and
+invalid slots) against a local stand-in for the EC2 spot price API, which
+returns paginated payloads after an injected latency, and throttles a
+share of the calls with --throttle.
+
+The cold path clears the spot price cache before every event, the warm
+path replays the corpus after a first pass has filled it.
+
+Usage: python bench_handler.py [--rounds 20] [--latency-ms 40] [--throttle 0]
+
+"""
+
+import argparse
+import collections
+import contextlib
+import datetime
+import os
+import random
+import tempfile
+import threading
+import time
+
+import lambda_function
+
+PRODUCT_DESCRIPTION = lambda_function.DEFAULT_PRODUCT_DESCRIPTION
+
+
+class StubEC2(object):
+    """
+    Stand-in for the EC2 client of a region: describe_spot_price_history
+    with a fixed latency per call, throttled with a given probability.
+    """
+
+    def __init__(self, amazon_region, latency, page_size, counter,
+                 throttle=0):
+        self.amazon_region = amazon_region
+        self.latency = latency
+        self.page_size = page_size
+        self.counter = counter
+        self.throttle = throttle
+        catalog = lambda_function.get_catalog()
+        self.instance_types = [info.name for info in catalog
+                               if amazon_region in info.regions]
+        self.zones = [amazon_region + zone for zone in 'abc']
+
+    def _price(self, instance_type, zone, hour):
+        seed = hash((instance_type, zone, hour)) & 0xffffffff
+        cpus, memory = lambda_function.get_catalog().resources(instance_type)
+        base = 0.004 * cpus + 0.0015 * memory
+        return '{:.6f}'.format(base * random.Random(seed).uniform(0.2, 0.5))
+
+    def _rows(self, instance_types, product_descriptions, start, end):
+        instance_types = instance_types or self.instance_types
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=datetime.timezone.utc)
+        if end is None:
+            # prices change every hour: the price in effect at the start
+            # time, and the ones set since then
+            hour = start.replace(minute=0, second=0, microsecond=0)
+            timestamps = []
+            while hour <= now:
+                timestamps.append(hour)
+                hour += datetime.timedelta(hours=1)
+        else:
+            end = end.replace(tzinfo=datetime.timezone.utc)
+            hours = int((end - start).total_seconds() // 3600)
+            timestamps = [start + datetime.timedelta(hours=hour)
+                          for hour in range(hours)]
+        return [{'InstanceType': instance_type,
+                 'ProductDescription': product_description,
+                 'SpotPrice': self._price(instance_type, zone,
+                                          timestamp.hour),
+                 'Timestamp': timestamp,
+                 'AvailabilityZone': zone}
+                for instance_type in instance_types
+                if instance_type in self.instance_types
+                for product_description in product_descriptions
+                for zone in self.zones
+                for timestamp in timestamps]
+
+    def describe_spot_price_history(self, StartTime=None, EndTime=None,
+                                    InstanceTypes=None,
+                                    ProductDescriptions=None, NextToken=None,
+                                    **kwargs):
+        self.counter.increment()
+        time.sleep(self.latency)
+        if random.random() < self.throttle:
+            raise StubThrottle()
+        rows = self._rows(InstanceTypes,
+                          ProductDescriptions or [PRODUCT_DESCRIPTION],
+                          StartTime, EndTime)
+        start = int(NextToken or 0)
+        end = start + self.page_size
+        return {'SpotPriceHistory': rows[start:end],
+                'NextToken': str(end) if end < len(rows) else ''}
+
+
+class StubThrottle(Exception):
+    """
+    Shaped like the botocore ClientError of a throttled call
+    """
+
+    response = {'Error': {'Code': 'RequestLimitExceeded'}}
+
+
+class CallCounter(object):
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def increment(self):
+        with self._lock:
+            self.calls += 1
+
+
+def lex_event(intent_name, slots, invocation_source):
+    return {
+        'userId': 'bench',
+        'bot': {'name': 'Sbot'},
+        'sessionAttributes': None,
+        'invocationSource': invocation_source,
+        'currentIntent': {'name': intent_name, 'slots': dict(slots)},
+    }
+
+
+VALID = ['DialogCodeHook', 'FulfillmentCodeHook']
+# Lex only fulfills an intent once the dialog code hook accepted its slots
+INVALID = ['DialogCodeHook']
+
+CORPUS = [
+    ('GetCurrentSpotInstancePrice',
+     {'InstanceType': 'c4.large', 'AmazonRegion': 'eu-west-1'}, VALID),
+    ('GetCurrentSpotInstancePrice',
+     {'InstanceType': 'r4.2xlarge', 'AmazonRegion': 'us-east-1'}, VALID),
+    ('GetCurrentSpotInstancePrice',
+     {'InstanceType': 'C4 Large', 'AmazonRegion': 'Dublin'}, VALID),
+    ('GetCurrentSpotInstancePrice',
+     {'InstanceType': 'c9.huge', 'AmazonRegion': 'eu-west-1'}, INVALID),
+    ('GetCurrentSpotInstancePrice',
+     {'InstanceType': 'c4.large', 'AmazonRegion': 'mars-west-1'}, INVALID),
+    ('GetCheapestSpotInstancesWithAtLeast',
+     {'AmazonRegion': 'eu-west-1', 'CPUs': '4', 'Memory': '16 GB'}, VALID),
+    ('GetCheapestSpotInstancesWithAtLeast',
+     {'AmazonRegion': 'us-west-2', 'CPUs': '32', 'Memory': '128gb'}, VALID),
+    ('GetCheapestSpotInstancesWithAtLeast',
+     {'AmazonRegion': 'eu-west-1', 'CPUs': '4', 'Memory': '16 GB',
+      'Ranking': 'price per vCPU'}, VALID),
+    ('GetCheapestSpotInstancesWithAtLeast',
+     {'AmazonRegion': 'anywhere', 'CPUs': '4', 'Memory': '16 GB'}, VALID),
+    ('GetCheapestSpotInstancesWithAtLeast',
+     {'AmazonRegion': 'eu-west-1', 'CPUs': '2', 'Memory': '2 PB'}, INVALID),
+    ('GetSpotSavings',
+     {'InstanceType': 'r4.2xlarge', 'AmazonRegion': 'eu-west-1'}, VALID),
+    ('GetInstanceTypes', {'CPUs': '8', 'Memory': '30 gigs'}, VALID),
+    ('GetInstanceTypes', {'CPUs': None, 'Memory': 'lots'}, INVALID),
+    ('GetCheapestRegionForInstanceType', {'InstanceType': 'm4.large'},
+     VALID),
+    ('GetSpotPriceHistory',
+     {'InstanceType': 'c4.large', 'AmazonRegion': 'eu-west-1',
+      'Period': 'P2W'}, VALID),
+    ('GetSpotPriceHistory',
+     {'InstanceType': 'c4.large', 'AmazonRegion': 'eu-west-1',
+      'Period': 'forever'}, INVALID),
+]
+
+
+def install_stub(latency, page_size, counter, throttle=0):
+    """
+    Fill the client registry with stubs so that no boto3 client is built
+    """
+    # prices stored by a real prewarm_handler must not be used
+    lambda_function.price_store.path = os.path.join(tempfile.mkdtemp(),
+                                                    'prices.sqlite')
+    lambda_function._ec2_clients.clear()
+    for amazon_region in lambda_function.get_catalog().regions:
+        lambda_function._ec2_clients[amazon_region] = StubEC2(
+            amazon_region, latency, page_size, counter, throttle)
+
+
+def replay(events, counter, cold):
+    """
+    Return {(intent_name, invocation_source): [(latency, ec2_calls)]}
+    """
+    results = collections.defaultdict(list)
+    # the metric lines printed by the handler are part of its cost
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for event in events:
+            if cold:
+                lambda_function.spot_price_cache.clear()
+                lambda_function.price_trend_cache.clear()
+                lambda_function.instance_types_response.cache_clear()
+            calls = counter.calls
+            started = time.perf_counter()
+            lambda_function.lambda_handler(
+                lex_event(event[0], event[1], event[2]), None)
+            elapsed = time.perf_counter() - started
+            results[(event[0], event[2])].append((elapsed,
+                                                  counter.calls - calls))
+    return results
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def report(path, results):
+    print('\n{} path'.format(path))
+    print('{:<36} {:<20} {:>8} {:>8} {:>8} {:>9} {:>6}'.format(
+        'intent', 'source', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'ec2'))
+    for (intent_name, source), samples in sorted(results.items()):
+        latencies = [sample[0] * 1000 for sample in samples]
+        calls = sum(sample[1] for sample in samples) / float(len(samples))
+        print('{:<36} {:<20} {:>8.2f} {:>8.2f} {:>8.2f} {:>9.1f} {:>6.2f}'
+              .format(intent_name, source, percentile(latencies, 50),
+                      percentile(latencies, 95), percentile(latencies, 99),
+                      1000.0 * len(latencies) / sum(latencies), calls))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=40)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--throttle', type=float, default=0,
+                        help='probability that a call is throttled')
+    args = parser.parse_args()
+
+    counter = CallCounter()
+    install_stub(args.latency_ms / 1000.0, args.page_size, counter,
+                 args.throttle)
+    corpus = [(intent_name, slots, source)
+              for intent_name, slots, sources in CORPUS
+              for source in sources]
+    events = corpus * args.rounds
+
+    report('Cold', replay(events, counter, cold=True))
+    replay(corpus, counter, cold=False)
+    report('Warm', replay(events, counter, cold=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Copyright (c) 2017 Sandtable Ltd. All rights reserved.
+
+"""
+Compile a local dump of describe_instance_types into the instance catalog
+loaded by lambda_function.py.
+
+The dump is a JSON object mapping each Amazon region to the output of
+`aws ec2 describe-instance-types --region <region>` in that region:
+
+    {"eu-west-1": {"InstanceTypes": [...]}, "us-east-1": {...}}
+
+Usage: python build_catalog.py dump.json [-o instance_catalog.bin]
+
+"""
+
+import argparse
+import json
+
+from lambda_function import (ARCHITECTURES, CATALOG_PATH, InstanceCatalog,
+                             InstanceTypeInfo, pack_catalog)
+
+
+def read_instance_types(dump):
+    """
+    Return a tuple (instance_types, regions) where instance_types is a list
+    of InstanceTypeInfo, from the parsed JSON dump
+    """
+    regions = sorted(dump)
+    if len(regions) > 64:
+        raise ValueError('The catalog supports 64 regions at most')
+
+    descriptions = {}
+    availability = {}
+    for region in regions:
+        for description in dump[region]['InstanceTypes']:
+            name = description['InstanceType']
+            descriptions.setdefault(name, description)
+            availability.setdefault(name, []).append(region)
+
+    instance_types = []
+    for name, description in descriptions.items():
+        architectures = [
+            architecture for architecture in
+            description.get('ProcessorInfo', {}).get(
+                'SupportedArchitectures', [])
+            if architecture in ARCHITECTURES
+        ]
+        gpus = sum(gpu.get('Count', 0) for gpu in
+                   description.get('GpuInfo', {}).get('Gpus', []))
+        instance_types.append(InstanceTypeInfo(
+            name,
+            description['VCpuInfo']['DefaultVCpus'],
+            description['MemoryInfo']['SizeInMiB'] / 1024.0,
+            tuple(architectures),
+            min(gpus, 255),
+            tuple(availability[name])))
+
+    return instance_types, regions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('dump', help='JSON dump of describe_instance_types')
+    parser.add_argument('-o', '--output', default=CATALOG_PATH,
+                        help='catalog file (default: %(default)s)')
+    args = parser.parse_args()
+
+    with open(args.dump) as dump_file:
+        instance_types, regions = read_instance_types(json.load(dump_file))
+
+    catalog = pack_catalog(instance_types, regions)
+    with open(args.output, 'wb') as catalog_file:
+        catalog_file.write(catalog)
+
+    print('{} instance types in {} regions, version {}, {} bytes'.format(
+        len(instance_types), len(regions), InstanceCatalog(catalog).version,
+        len(catalog)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+# Copyright (c) 2017 Sandtable Ltd. All rights reserved.
+
+"""
+Compile a local copy of the AWS price list of EC2 into the on-demand prices
+loaded by lambda_function.py.
+
+The price list is the offer file of AmazonEC2, for every region or a single
+one, e.g.
+
+    https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/index.json
+
+It is hundreds of megabytes: it is read in chunks, only the products and
+on-demand terms of Linux instances with shared tenancy are decoded, and
+everything else is skipped without being built. Only the instance types and
+regions of the instance catalog are kept.
+
+Usage: python build_ondemand.py index.json [-o ondemand_prices.bin]
+
+"""
+
+import argparse
+import json
+import re
+
+from lambda_function import (ONDEMAND_PATH, OnDemandPrices, get_catalog,
+                             pack_ondemand_prices)
+
+CHUNK_SIZE = 1024 * 1024
+
+# a string, or a bracket outside of the strings
+TOKEN_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+WHITESPACE_PATTERN = re.compile(r'\s*')
+
+# attributes of the products that are the rate of a Linux instance without
+# pre-installed software, shared with other accounts
+LINUX_ATTRIBUTES = {
+    'operatingSystem': 'Linux',
+    'tenancy': 'Shared',
+    'preInstalledSw': 'NA',
+    'capacitystatus': 'Used',
+}
+
+
+class JsonStream(object):
+    """
+    Pull parser of a JSON file, that decodes the values it is asked for
+    and skips the others, keeping a single chunk of the file in memory
+    """
+
+    def __init__(self, json_file, chunk_size=CHUNK_SIZE):
+        self._file = json_file
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._position = 0
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """
+        Read the next chunk. Return False at the end of the file.
+        """
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            return False
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def _peek(self):
+        """
+        Return the next character that is not a whitespace, '' at the end
+        of the file
+        """
+        while True:
+            self._position = WHITESPACE_PATTERN.match(
+                self._buffer, self._position).end()
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill():
+                return ''
+
+    def _expect(self, characters):
+        character = self._peek()
+        if not character or character not in characters:
+            raise ValueError('Expected {!r} at {!r}'.format(
+                characters, self._buffer[self._position:][:40]))
+        self._position += 1
+        return character
+
+    def read_value(self):
+        """
+        Decode the next value
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer,
+                                                      self._position)
+            except ValueError:
+                value, end = None, None
+            # a number may go on in the next chunk
+            if end is not None and end < len(self._buffer):
+                self._position = end
+                return value
+            if not self._fill():
+                if end is None:
+                    raise ValueError('Truncated JSON')
+                self._position = end
+                return value
+
+    def skip_value(self):
+        """
+        Go past the next value without decoding it
+        """
+        if self._peek() not in '{[':
+            self.read_value()
+            return
+        depth = 0
+        while True:
+            match = TOKEN_PATTERN.search(self._buffer, self._position)
+            # a quote before the token opens a string the chunk cuts
+            if (match is None or
+                    '"' in self._buffer[self._position:match.start()]):
+                if not self._fill():
+                    raise ValueError('Truncated JSON')
+                continue
+            self._position = match.end()
+            token = match.group()
+            if token in '{[':
+                depth += 1
+            elif token in '}]':
+                depth -= 1
+                if not depth:
+                    return
+
+    def iter_object(self):
+        """
+        Yield the keys of the next object. The value of each key must be
+        read or skipped before the next one.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self._position += 1
+            return
+        while True:
+            key = self.read_value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+
+def is_linux_instance(product, instance_types, regions):
+    attributes = product.get('attributes', {})
+    return (product.get('productFamily', '').startswith('Compute Instance')
+            and attributes.get('instanceType') in instance_types
+            and attributes.get('regionCode') in regions
+            and all(attributes.get(name, value) == value
+                    for name, value in LINUX_ATTRIBUTES.items()))
+
+
+def hourly_price(offers):
+    """
+    Return the price per hour in USD of the on-demand offers of a product,
+    None when there is none
+    """
+    prices = [
+        float(dimension['pricePerUnit']['USD'])
+        for offer in offers.values()
+        for dimension in offer.get('priceDimensions', {}).values()
+        if dimension.get('unit') == 'Hrs' and
+        'USD' in dimension.get('pricePerUnit', {})
+    ]
+    prices = [price for price in prices if price > 0]
+    return min(prices) if prices else None
+
+
+def read_ondemand_prices(stream, instance_types, regions):
+    """
+    Return a dict {(amazon_region, instance_type): price per hour} of the
+    on-demand Linux prices of the price list
+    """
+    products = {}
+    prices = {}
+    for key in stream.iter_object():
+        if key == 'products':
+            for sku in stream.iter_object():
+                product = stream.read_value()
+                if is_linux_instance(product, instance_types, regions):
+                    attributes = product['attributes']
+                    products[sku] = (attributes['regionCode'],
+                                     attributes['instanceType'])
+        elif key == 'terms':
+            for term_type in stream.iter_object():
+                if term_type != 'OnDemand':
+                    stream.skip_value()
+                    continue
+                for sku in stream.iter_object():
+                    if sku not in products:
+                        stream.skip_value()
+                        continue
+                    price = hourly_price(stream.read_value())
+                    if price is not None:
+                        prices[products[sku]] = price
+        else:
+            stream.skip_value()
+    return prices
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('price_list', help='JSON offer file of AmazonEC2')
+    parser.add_argument('-o', '--output', default=ONDEMAND_PATH,
+                        help='on-demand prices file (default: %(default)s)')
+    args = parser.parse_args()
+
+    catalog = get_catalog()
+    instance_types = sorted(info.name for info in catalog)
+    regions = list(catalog.regions)
+    with open(args.price_list, encoding='utf-8') as price_list:
+        prices = read_ondemand_prices(JsonStream(price_list),
+                                      set(instance_types), set(regions))
+
+    table = pack_ondemand_prices(prices, regions, instance_types)
+    with open(args.output, 'wb') as prices_file:
+        prices_file.write(table)
+
+    print('{} on-demand prices of {} instance types in {} regions, '
+          '{} bytes'.format(len(OnDemandPrices(table)), len(instance_types),
+                            len(regions), len(table)))
+
+
+if __name__ == '__main__':
+    main()
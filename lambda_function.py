@@ -8,13 +8,39 @@ AWS Spot prices.
 
 """
 
-import datetime
-import logging
-
-import boto3
-
+import time
+
+# the setup of the cold start is timed from here, so that it includes the
+# imports below; boto3 and numpy are imported on first use, so that cold
+# starts of questions that never call AWS do not pay for them
+_init_started = time.perf_counter()
+
+import array  # noqa: E402
+import bisect  # noqa: E402
+import collections  # noqa: E402
+import concurrent.futures  # noqa: E402
+import contextlib  # noqa: E402
+import contextvars  # noqa: E402
+import datetime  # noqa: E402
+import functools  # noqa: E402
+import hashlib  # noqa: E402
+import heapq  # noqa: E402
+import importlib  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import mmap  # noqa: E402
+import os  # noqa: E402
+import random  # noqa: E402
+import re  # noqa: E402
+import struct  # noqa: E402
+import sys  # noqa: E402
+import threading  # noqa: E402
+
+INIT_STATS = {'setup_ms': None, 'imports_ms': {}, 'reported': False}
+
+# debug messages are formatted by logging only when the level enables them
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 logging.getLogger('botocore').setLevel(logging.CRITICAL)
 logging.getLogger('boto3').setLevel(logging.CRITICAL)
 
@@ -102,6 +128,959 @@ AMAZON_REGIONS = ['us-east-2', 'us-east-1', 'us-west-1', 'us-west-2',
                   'ap-southeast-1', 'ap-southeast-2', 'ap-northeast-1',
                   'eu-central-1', 'eu-west-1', 'eu-west-2', 'sa-east-1']
 
+# budget of an invocation: answers must reach Lex before its deadline
+LEX_DEADLINE_MS = int(os.environ.get('LEX_DEADLINE_MS', '4000'))
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', '300'))
+
+# EC2 clients are expensive to build (service model loading, TLS handshake),
+# so we keep one per region for the lifetime of the container
+# (retries are made by call_ec2, within the budget of the invocation, and a
+# connection or read does not last longer than the whole budget)
+EC2_TIMEOUT = max(LEX_DEADLINE_MS - DEADLINE_MARGIN_MS, 1000) / 1000.0
+EC2_CLIENT_OPTIONS = {'max_pool_connections': 10, 'tcp_keepalive': True,
+                      'connect_timeout': EC2_TIMEOUT,
+                      'read_timeout': EC2_TIMEOUT,
+                      'retries': {'mode': 'standard',
+                                  'total_max_attempts': 1}}
+
+_ec2_clients = {}
+_ec2_clients_lock = threading.Lock()
+EC2_CLIENT_STATS = {'created': 0, 'reused': 0}
+# the fan-out threads of the regions count reuses at the same time
+_ec2_client_stats_lock = threading.Lock()
+
+# EC2 throttles its API per account and region: the calls to a region are
+# paced by a token bucket, throttled calls are retried with jittered
+# exponential backoff, and a region failing CIRCUIT_FAILURES times in a row
+# is not called for CIRCUIT_COOLDOWN seconds
+EC2_RATE = float(os.environ.get('EC2_RATE', '5'))
+EC2_BURST = int(os.environ.get('EC2_BURST', '10'))
+EC2_RETRIES = int(os.environ.get('EC2_RETRIES', '4'))
+EC2_BACKOFF = float(os.environ.get('EC2_BACKOFF', '0.1'))
+EC2_BACKOFF_MAX = float(os.environ.get('EC2_BACKOFF_MAX', '2'))
+THROTTLING_ERRORS = {'RequestLimitExceeded', 'Throttling',
+                     'ThrottlingException', 'TooManyRequestsException'}
+RETRYABLE_ERRORS = THROTTLING_ERRORS | {'InternalError', 'ServiceUnavailable',
+                                        'Unavailable', 'RequestTimeout'}
+CIRCUIT_FAILURES = int(os.environ.get('CIRCUIT_FAILURES', '3'))
+CIRCUIT_COOLDOWN = float(os.environ.get('CIRCUIT_COOLDOWN', '30'))
+
+_region_guards = {}
+_region_guards_lock = threading.Lock()
+
+DEFAULT_PRODUCT_DESCRIPTION = 'Linux/UNIX (Amazon VPC)'
+
+# values of the Product slot and their product description
+PRODUCT_DESCRIPTIONS = {
+    'linux': 'Linux/UNIX (Amazon VPC)',
+    'unix': 'Linux/UNIX (Amazon VPC)',
+    'windows': 'Windows (Amazon VPC)',
+    'suse': 'SUSE Linux (Amazon VPC)',
+    'red hat': 'Red Hat Enterprise Linux (Amazon VPC)',
+    'redhat': 'Red Hat Enterprise Linux (Amazon VPC)',
+    'rhel': 'Red Hat Enterprise Linux (Amazon VPC)',
+}
+# several products can be compared, e.g. "Linux vs Windows"
+PRODUCT_SEPARATOR = re.compile(r'\s*(?:,|&|\bvs\b\.?|\bversus\b|\band\b)\s*')
+
+# values of the Ranking slot and the resource the price is divided by
+RANKINGS = {
+    'price': None,
+    'total price': None,
+    'price per vcpu': 'cpu',
+    'price per cpu': 'cpu',
+    'price per core': 'cpu',
+    'price per gb': 'memory',
+    'price per gb of memory': 'memory',
+    'price per gb of ram': 'memory',
+}
+# number of instance types in the answer to the cheapest instances
+CHEAPEST_TOP_K = int(os.environ.get('CHEAPEST_TOP_K', '5'))
+
+# snapshots of the spot prices of a region are shared between validation and
+# fulfillment of the same question, and between questions in a warm container
+SPOT_PRICE_CACHE_TTL = float(os.environ.get('SPOT_PRICE_CACHE_TTL', '60'))
+SPOT_PRICE_CACHE_SIZE = int(os.environ.get('SPOT_PRICE_CACHE_SIZE', '256'))
+
+# answers must reach Lex before its deadline: when EC2 is too slow, we answer
+# with the last known prices and let the refresh finish in the background
+SPOT_PRICE_STALE_MAX_AGE = float(
+    os.environ.get('SPOT_PRICE_STALE_MAX_AGE', '3600'))
+
+_current_deadline = contextvars.ContextVar('deadline', default=None)
+# {(amazon_region, product_description): age} of the prices the invocation
+# used that may not be fresh: expired snapshots and those of the price store
+_current_stale = contextvars.ContextVar('stale', default=None)
+# loads in flight, keyed by (amazon_region, product_description) for the
+# snapshots and (amazon_region, instance_type, product_description, period)
+# for the price trends
+_refreshes = {}
+_refreshes_lock = threading.Lock()
+
+# prewarm_handler runs on a schedule and stores the snapshots of all the
+# regions, and the answers for common thresholds, for the interactive intents
+PRICE_STORE_PATH = os.environ.get('PRICE_STORE_PATH',
+                                  '/tmp/sbot_prices.sqlite')
+PRICE_STORE_MAX_AGE = float(os.environ.get('PRICE_STORE_MAX_AGE', '180'))
+PRECOMPUTED_THRESHOLDS = [(cpu, memory)
+                          for cpu in (1, 2, 4, 8, 16, 32, 64)
+                          for memory in (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)]
+
+# users watch the prices of instance types: their watches are evaluated by
+# prewarm_handler against each new snapshot, and the alerts are told in the
+# next answer to the user. The file must be on storage shared by the
+# containers and kept when they are recycled (e.g. EFS): /tmp belongs to a
+# single container
+WATCH_STORE_PATH = os.environ.get('WATCH_STORE_PATH',
+                                  '/tmp/sbot_watches.sqlite')
+WATCH_MAX_AGE = float(os.environ.get('WATCH_MAX_AGE', str(30 * 24 * 3600)))
+
+# cross-region questions query every region at once, and give up on the
+# regions that did not answer in time
+REGION_WORKERS = int(os.environ.get('REGION_WORKERS', len(AMAZON_REGIONS)))
+REGION_TIMEOUT = float(os.environ.get('REGION_TIMEOUT', '2.5'))
+_region_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=REGION_WORKERS)
+# loads run in their own pool, the region workers wait for them
+_refresh_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=REGION_WORKERS)
+
+# answers to the intents that only depend on their slots and the catalog
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '512'))
+
+# slot values close enough to a known one are corrected instead of asked
+# again: names of the regions, and memory units other than GB
+REGION_ALIASES = {
+    'us-east-1': ('N. Virginia', 'Northern Virginia', 'Virginia'),
+    'us-east-2': ('Ohio',),
+    'us-west-1': ('N. California', 'Northern California', 'California'),
+    'us-west-2': ('Oregon',),
+    'ca-central-1': ('Canada', 'Montreal'),
+    'sa-east-1': ('Sao Paulo', 'Brazil'),
+    'eu-west-1': ('Ireland', 'Dublin'),
+    'eu-west-2': ('London', 'UK', 'United Kingdom', 'England'),
+    'eu-west-3': ('Paris', 'France'),
+    'eu-central-1': ('Frankfurt', 'Germany'),
+    'eu-north-1': ('Stockholm', 'Sweden'),
+    'eu-south-1': ('Milan', 'Italy'),
+    'ap-south-1': ('Mumbai', 'India'),
+    'ap-east-1': ('Hong Kong',),
+    'ap-northeast-1': ('Tokyo', 'Japan'),
+    'ap-northeast-2': ('Seoul', 'Korea'),
+    'ap-northeast-3': ('Osaka',),
+    'ap-southeast-1': ('Singapore',),
+    'ap-southeast-2': ('Sydney', 'Australia'),
+    'me-south-1': ('Bahrain',),
+    'af-south-1': ('Cape Town', 'South Africa'),
+}
+# AmazonRegion values of the cheapest instances across every region
+ANY_REGION = 'anywhere'
+ANY_REGION_NAMES = ('anywhere', 'any region', 'all regions', 'every region',
+                    'everywhere')
+# typos are only corrected in the size of an instance type ("r4.2xlarg"),
+# never in its family, generation, attributes or size multiplier, and never
+# in a region code
+INSTANCE_TYPE_PATTERN = re.compile(
+    r'^([a-z]+)(\d+)([a-z]*)[.\s_-]+(\d*)[a-z]+$')
+REGION_CODE_PATTERN = re.compile(r'^[a-z]{2}(?:-gov)?[-\s]+[a-z]+[-\s]*\d+$')
+MEMORY_PATTERN = re.compile(r'\s*(\d+(?:[.,]\d+)?)\s*([a-z]*)', re.IGNORECASE)
+# GB per unit
+MEMORY_UNITS = {
+    '': 1, 'g': 1, 'gb': 1, 'gib': 1, 'gig': 1, 'gigs': 1, 'gigabyte': 1,
+    'gigabytes': 1,
+    'm': 1 / 1024.0, 'mb': 1 / 1024.0, 'mib': 1 / 1024.0,
+    'megabyte': 1 / 1024.0, 'megabytes': 1 / 1024.0,
+    't': 1024, 'tb': 1024, 'tib': 1024, 'terabyte': 1024, 'terabytes': 1024,
+}
+
+# EC2 keeps 90 days of spot price history
+DEFAULT_HISTORY_PERIOD = datetime.timedelta(days=7)
+MAX_HISTORY_PERIOD = datetime.timedelta(days=90)
+HISTORY_BUCKETS = int(os.environ.get('HISTORY_BUCKETS', '12'))
+
+# instance catalog compiled by build_catalog.py, the literals above are used
+# when it is not deployed with the function
+CATALOG_PATH = os.environ.get(
+    'CATALOG_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 'instance_catalog.bin'))
+
+# on-demand Linux prices compiled by build_ondemand.py, the savings are not
+# known when it is not deployed with the function
+ONDEMAND_PATH = os.environ.get(
+    'ONDEMAND_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 'ondemand_prices.bin'))
+
+# AMAZON.DURATION values are ISO-8601 durations, e.g. P2W, P3D or PT12H
+DURATION_PATTERN = re.compile(
+    r'^P(?:(?P<weeks>\d+)W)?(?:(?P<days>\d+)D)?'
+    r'(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?)?$')
+
+
+# --- Deferred imports ---
+
+
+def import_module(name):
+    """
+    Import a module on first use and record how long the import took
+    """
+    module = sys.modules.get(name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        INIT_STATS['imports_ms'][name] = round(
+            (time.perf_counter() - started) * 1000, 2)
+    return module
+
+
+def optional_numpy():
+    """
+    Return numpy, or None as it is not part of the Lambda runtime
+    """
+    try:
+        return import_module('numpy')
+    except ImportError:
+        return None
+
+
+# --- Metrics of the invocations ---
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Sbot')
+
+# share of the invocations profiled, or those whose session attribute
+# "profile" is "true". The profiles are written to PROFILE_OUTPUT, a
+# directory, or "log" to log them
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_OUTPUT = os.environ.get('PROFILE_OUTPUT', '/tmp')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.001'))
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', '25'))
+
+# invocations profiled at the same time share the allocation trace, which
+# is stopped by the last one, unless it was on before the first one
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = {'count': 0, 'started': False}
+
+_current_metrics = contextvars.ContextVar('metrics', default=None)
+
+
+class InvocationMetrics(object):
+    """
+    Span durations (ms) and counters of one invocation. Spans of the same
+    name are added up.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = collections.defaultdict(float)
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, duration):
+        with self._lock:
+            self.spans[name] += duration
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def to_emf(self, dimensions):
+        """
+        Return the metrics in the CloudWatch embedded metric format
+        """
+        metrics = {
+            'Duration': (time.perf_counter() - self.started) * 1000,
+            'ApiCalls': self.counters['api_calls'],
+            'CacheHits': self.counters['cache_hits'],
+            'CacheMisses': self.counters['cache_misses'],
+            'StaleAnswers': self.counters['stale_answers'],
+            'StoreHits': self.counters['store_hits'],
+            'DeadlineExceeded': self.counters['deadline_exceeded'],
+            'BytesReturned': self.counters['bytes_returned'],
+            'CoalescedCalls': self.counters['coalesced_calls'],
+            'CorrectedSlots': self.counters['corrected_slots'],
+            'Throttles': self.counters['throttles'],
+            'ShortCircuits': self.counters['short_circuits'],
+        }
+        units = {'Duration': 'Milliseconds', 'BytesReturned': 'Bytes'}
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [sorted(dimensions)],
+                    'Metrics': [{'Name': name,
+                                 'Unit': units.get(name, 'Count')}
+                                for name in sorted(metrics)],
+                }],
+            },
+            'spans': {name: round(duration, 3)
+                      for name, duration in self.spans.items()},
+        }
+        document.update(dimensions)
+        document.update(metrics)
+        return document
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Time the block into the metrics of the current invocation, if any
+    """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_span(name, (time.perf_counter() - started) * 1000)
+
+
+def timed(function):
+    """
+    Decorator timing every call of the function in a span of its name
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def increment(name, value=1):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.increment(name, value)
+
+
+# --- Profiling of the invocations ---
+
+
+class StackSampler(object):
+    """
+    Count the stacks of every other thread every interval seconds, as
+    collapsed stacks "thread;file:function;... samples". The invocation
+    spreads over the threads of the region executors, which a profiler
+    of the calling thread would not see.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sbot-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        thread_names = {}
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                # idle workers of the executors
+                if frame.f_code.co_name == '_worker':
+                    continue
+                if ident not in thread_names:
+                    thread_names.update((thread.ident, thread.name)
+                                        for thread in threading.enumerate())
+                stack = []
+                while frame is not None:
+                    stack.append('{}:{}'.format(
+                        os.path.basename(frame.f_code.co_filename),
+                        frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, 'thread'))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self, top=None):
+        """
+        Return the collapsed stacks, the top ones by samples if given
+        """
+        return ''.join('{} {}\n'.format(stack, samples)
+                       for stack, samples in self.stacks.most_common(top))
+
+
+def should_profile(event):
+    """
+    It's profiled if asked by the session attribute "profile", or sampled
+    at PROFILE_SAMPLE_RATE
+    """
+    session_attributes = event.get('sessionAttributes') or {}
+    if str(session_attributes.get('profile', '')).lower() == 'true':
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+@contextlib.contextmanager
+def profiled(event, context):
+    """
+    Sample the stacks and trace the allocations within the block, then
+    write the collapsed stacks and the top allocations to PROFILE_OUTPUT
+    """
+    tracemalloc = import_module('tracemalloc')
+    with _tracemalloc_lock:
+        if not _tracemalloc_users['count'] and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_users['started'] = True
+        _tracemalloc_users['count'] += 1
+    sampler = StackSampler(PROFILE_INTERVAL)
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        duration_ms = (time.perf_counter() - started) * 1000
+        # a failing profile must not fail the invocation, nor hide the
+        # exception of its handler
+        try:
+            with _tracemalloc_lock:
+                try:
+                    snapshot = tracemalloc.take_snapshot().filter_traces(
+                        [tracemalloc.Filter(False, tracemalloc.__file__)])
+                    peak = tracemalloc.get_traced_memory()[1]
+                finally:
+                    _tracemalloc_users['count'] -= 1
+                    if (not _tracemalloc_users['count'] and
+                            _tracemalloc_users['started']):
+                        tracemalloc.stop()
+                        _tracemalloc_users['started'] = False
+            allocations = [
+                '{}:{} {} KiB in {} blocks'.format(
+                    os.path.basename(statistic.traceback[0].filename),
+                    statistic.traceback[0].lineno,
+                    round(statistic.size / 1024.0, 1), statistic.count)
+                for statistic in snapshot.statistics('lineno')[:PROFILE_TOP]
+            ]
+            write_profile({
+                'metric': 'profile',
+                'request_id': (getattr(context, 'aws_request_id', None) or
+                               os.urandom(8).hex()),
+                'intent': (event.get('currentIntent') or {}).get('name'),
+                'duration_ms': round(duration_ms, 2),
+                'peak_kib': round(peak / 1024.0, 1),
+                'samples': sum(sampler.stacks.values()),
+            }, sampler, allocations)
+        except Exception:
+            logger.exception('Could not write the profile')
+
+
+def write_profile(summary, sampler, allocations):
+    """
+    Log the profile, or write its collapsed stacks and allocations next to
+    each other in PROFILE_OUTPUT and log where they are
+    """
+    if PROFILE_OUTPUT == 'log':
+        summary['stacks'] = sampler.collapsed(PROFILE_TOP).splitlines()
+        summary['allocations'] = allocations
+    else:
+        prefix = os.path.join(PROFILE_OUTPUT, 'sbot-{}'.format(
+            summary['request_id']))
+        with open(prefix + '.collapsed', 'w') as stacks_file:
+            stacks_file.write(sampler.collapsed())
+        with open(prefix + '.allocations', 'w') as allocations_file:
+            allocations_file.write(''.join(
+                allocation + '\n' for allocation in allocations))
+        summary['files'] = [prefix + '.collapsed', prefix + '.allocations']
+    logger.info(json.dumps(summary, sort_keys=True))
+
+
+# --- Index of the instance types ---
+
+
+class InstanceTypeIndex(object):
+    """
+    Instance types sorted by (vCPU, Memory, name), so that resource range
+    queries bisect on the vCPU and only filter the memory of the matches.
+    """
+
+    ORDERS = {
+        'name': lambda entry: entry[2],
+        'size': None,
+        'family': lambda entry: (entry[2].split('.')[0], entry[0], entry[1]),
+    }
+
+    def __init__(self, instance_types):
+        self._entries = sorted((cpu, memory, instance_type)
+                               for instance_type, (cpu, memory)
+                               in instance_types.items())
+        self._cpus = [entry[0] for entry in self._entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def query(self, min_cpu=0, min_memory=0, max_cpu=None, max_memory=None,
+              order_by='name'):
+        """
+        Return the instance types whose vCPU and Memory are within the
+        (inclusive) bounds, ordered by name, size or family
+        """
+        low = bisect.bisect_left(self._cpus, min_cpu)
+        if max_cpu is None:
+            high = len(self._entries)
+        else:
+            high = bisect.bisect_right(self._cpus, max_cpu)
+
+        entries = [entry for entry in self._entries[low:high]
+                   if entry[1] >= min_memory and
+                   (max_memory is None or entry[1] <= max_memory)]
+
+        # the entries are already sorted by size
+        key = self.ORDERS[order_by]
+        if key is not None:
+            entries.sort(key=key)
+        return [entry[2] for entry in entries]
+
+
+# --- Normalization of the slots ---
+
+
+def squash(value):
+    """
+    Return the value in lower case without spaces and punctuation, so that
+    "C4 Large" and "c4.large" have the same key
+    """
+    return re.sub(r'[^a-z0-9]', '', value.lower())
+
+
+def trigrams(key):
+    padded = '$' + key + '$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b):
+    """
+    Return the Levenshtein distance between the strings a and b
+    """
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+class NameIndex(object):
+    """
+    Names and their aliases by squashed key, for exact lookups, and a
+    trigram index of the keys to suggest a name for a typo: the keys sharing
+    the most trigrams with a value are compared to it by edit distance.
+    tokens(value) returns the parts of a value a typo can not change, e.g.
+    the family, generation and size of an instance type, None when the
+    value must not be corrected at all.
+    """
+
+    CANDIDATES = 10
+
+    def __init__(self, aliases, tokens=None):
+        """
+        aliases is a dict {alias: name}
+        """
+        self._tokens = tokens or (lambda value: ())
+        self._names = {}
+        self._key_tokens = {}
+        self._trigrams = collections.defaultdict(list)
+        for alias, name in aliases.items():
+            key = squash(alias)
+            if key not in self._names:
+                self._names[key] = name
+                self._key_tokens[key] = self._tokens(alias)
+                for trigram in trigrams(key):
+                    self._trigrams[trigram].append(key)
+
+    def __len__(self):
+        return len(self._names)
+
+    def lookup(self, value):
+        """
+        Return the name the value stands for, ignoring case, spaces and
+        punctuation, None if it is unknown
+        """
+        return self._names.get(squash(value))
+
+    def suggest(self, value):
+        """
+        Return the name an unknown value is a typo of, None if it is not
+        close to a name with the same tokens or as close to several names
+        """
+        key = squash(value)
+        tokens = self._tokens(value)
+        if len(key) < 3 or tokens is None:
+            return None
+
+        shared = collections.Counter(
+            candidate for trigram in trigrams(key)
+            for candidate in self._trigrams.get(trigram, ())
+            if self._key_tokens[candidate] == tokens)
+        # short values only get one typo
+        max_distance = 1 if len(key) < 6 else 2
+        best = max_distance + 1
+        names = set()
+        for candidate, _ in shared.most_common(self.CANDIDATES):
+            distance = edit_distance(key, candidate)
+            if distance < best:
+                best = distance
+                names = {self._names[candidate]}
+            elif distance == best:
+                names.add(self._names[candidate])
+        if best > max_distance or len(names) != 1:
+            return None
+        return names.pop()
+
+
+def instance_type_tokens(value):
+    """
+    Return the tuple (family, generation, attributes, size multiplier) of
+    an instance type, e.g. ('x', '1', 'e', '32') for "x1e.32xlarge", None
+    when it is not shaped like one
+    """
+    match = INSTANCE_TYPE_PATTERN.match(value.strip().lower())
+    return match.groups() if match else None
+
+
+def region_tokens(value):
+    """
+    Region codes are never corrected, only the names of their cities and
+    countries
+    """
+    return None if REGION_CODE_PATTERN.match(value.strip().lower()) else ()
+
+
+def parse_memory_gb(memory):
+    """
+    Return the amount of memory of a Memory slot value in GB, converting
+    MB and TB, None if it has no amount or an unknown unit
+    """
+    match = MEMORY_PATTERN.match(memory)
+    if not match:
+        return None
+    factor = MEMORY_UNITS.get(match.group(2).lower())
+    if factor is None:
+        return None
+    return float(match.group(1).replace(',', '.')) * factor
+
+
+# --- Catalog of the instance types ---
+
+# catalog file layout: a header, the names of the regions, then one record
+# per instance type sorted by name
+CATALOG_MAGIC = b'SBOTCAT\0'
+CATALOG_FORMAT_VERSION = 1
+CATALOG_HEADER = struct.Struct('<8sHHI16s')
+CATALOG_REGION = struct.Struct('<16s')
+# name, vCPUs, memory (MiB), architectures, GPUs, regions bitmask
+CATALOG_RECORD = struct.Struct('<32sHIBBQ')
+ARCHITECTURES = ('i386', 'x86_64', 'arm64', 'x86_64_mac', 'arm64_mac')
+
+# positions is a dict {instance_type: position}, the other columns are
+# indexed by position
+CatalogColumns = collections.namedtuple(
+    'CatalogColumns', ['positions', 'names', 'cpus', 'memory'])
+
+InstanceTypeInfo = collections.namedtuple(
+    'InstanceTypeInfo',
+    ['name', 'cpus', 'memory', 'architectures', 'gpus', 'regions'])
+
+
+def pack_catalog(instance_types, regions):
+    """
+    instance_types is a list of InstanceTypeInfo, with memory in GB
+    regions is the list of the Amazon regions, 64 at most
+    Return the catalog as bytes
+    """
+    region_bits = {region: 1 << bit for bit, region in enumerate(regions)}
+    records = b''.join(
+        CATALOG_RECORD.pack(
+            info.name.encode('ascii'), info.cpus,
+            int(round(info.memory * 1024)),
+            sum(1 << ARCHITECTURES.index(architecture)
+                for architecture in info.architectures),
+            info.gpus,
+            sum(region_bits[region] for region in info.regions))
+        for info in sorted(instance_types))
+    body = b''.join(CATALOG_REGION.pack(region.encode('ascii'))
+                    for region in regions) + records
+    version = hashlib.sha1(body).hexdigest()[:16].encode('ascii')
+    header = CATALOG_HEADER.pack(CATALOG_MAGIC, CATALOG_FORMAT_VERSION,
+                                 len(regions), len(instance_types), version)
+    return header + body
+
+
+class InstanceCatalog(object):
+    """
+    Read-only view over a packed catalog. Records are decoded on lookup, by
+    binary search on the names, so loading a memory-mapped catalog does not
+    parse it.
+    """
+
+    def __init__(self, buffer):
+        magic, format_version, region_count, self._count, version = (
+            CATALOG_HEADER.unpack_from(buffer, 0))
+        if magic != CATALOG_MAGIC or format_version != CATALOG_FORMAT_VERSION:
+            raise ValueError('Unsupported instance catalog')
+        self.version = version.decode('ascii')
+        self.regions = [
+            CATALOG_REGION.unpack_from(
+                buffer, CATALOG_HEADER.size + i * CATALOG_REGION.size
+            )[0].rstrip(b'\0').decode('ascii')
+            for i in range(region_count)
+        ]
+        self._buffer = buffer
+        self._records = (CATALOG_HEADER.size +
+                         region_count * CATALOG_REGION.size)
+        self._index = None
+        self._names = None
+        self._region_names = None
+        self._columns = None
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as catalog_file:
+            return cls(mmap.mmap(catalog_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ))
+
+    @classmethod
+    def from_literals(cls, instance_types, regions):
+        return cls(pack_catalog(
+            [InstanceTypeInfo(name, cpus, memory, ('x86_64',), 0, regions)
+             for name, (cpus, memory) in instance_types.items()],
+            regions))
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, instance_type):
+        return self._find(instance_type) is not None
+
+    def __iter__(self):
+        for position in range(self._count):
+            yield self._record(position)
+
+    def _name(self, position):
+        offset = self._records + position * CATALOG_RECORD.size
+        return bytes(self._buffer[offset:offset + 32]).rstrip(b'\0')
+
+    def _find(self, instance_type):
+        name = instance_type.encode('ascii', 'replace')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._name(low) == name:
+            return low
+        return None
+
+    def _record(self, position):
+        name, cpus, memory, architectures, gpus, regions = (
+            CATALOG_RECORD.unpack_from(
+                self._buffer,
+                self._records + position * CATALOG_RECORD.size))
+        memory = round(memory / 1024.0, 2)
+        return InstanceTypeInfo(
+            name.rstrip(b'\0').decode('ascii'), cpus,
+            int(memory) if memory.is_integer() else memory,
+            tuple(architecture
+                  for bit, architecture in enumerate(ARCHITECTURES)
+                  if architectures & 1 << bit),
+            gpus,
+            tuple(region for bit, region in enumerate(self.regions)
+                  if regions & 1 << bit))
+
+    def get(self, instance_type):
+        """
+        Return the InstanceTypeInfo of the instance type, None if unknown
+        """
+        position = self._find(instance_type)
+        return self._record(position) if position is not None else None
+
+    def resources(self, instance_type):
+        """
+        Return the tuple (vCPU, Memory in GB) of the instance type
+        """
+        info = self.get(instance_type)
+        return (info.cpus, info.memory) if info else (None, None)
+
+    @property
+    def index(self):
+        """
+        InstanceTypeIndex of all the instance types, built on first use
+        """
+        if self._index is None:
+            self._index = InstanceTypeIndex(
+                {info.name: (info.cpus, info.memory) for info in self})
+        return self._index
+
+    @property
+    def columns(self):
+        """
+        CatalogColumns of the instance types by position, built on first use
+        """
+        if self._columns is None:
+            names = []
+            cpus = array.array('d')
+            memory = array.array('d')
+            for info in self:
+                names.append(info.name)
+                cpus.append(info.cpus)
+                memory.append(info.memory)
+            self._columns = CatalogColumns(
+                {name: position for position, name in enumerate(names)},
+                names, cpus, memory)
+        return self._columns
+
+    @property
+    def names(self):
+        """
+        NameIndex of the instance types, built on first use
+        """
+        if self._names is None:
+            self._names = NameIndex({info.name: info.name for info in self},
+                                    instance_type_tokens)
+        return self._names
+
+    @property
+    def region_names(self):
+        """
+        NameIndex of the regions and their REGION_ALIASES, built on first use
+        """
+        if self._region_names is None:
+            aliases = {region: region for region in self.regions}
+            for region in self.regions:
+                for alias in REGION_ALIASES.get(region, ()):
+                    aliases[alias] = region
+            self._region_names = NameIndex(aliases, region_tokens)
+        return self._region_names
+
+
+_catalog = None
+
+
+def get_catalog():
+    """
+    Return the instance catalog, memory-mapped from CATALOG_PATH on first
+    use or built from INSTANCE_TYPES and AMAZON_REGIONS when it is missing
+    """
+    global _catalog
+    if _catalog is None:
+        if os.path.exists(CATALOG_PATH):
+            _catalog = InstanceCatalog.from_file(CATALOG_PATH)
+        else:
+            _catalog = InstanceCatalog.from_literals(INSTANCE_TYPES,
+                                                     AMAZON_REGIONS)
+    return _catalog
+
+
+# --- On-demand prices ---
+
+# on-demand file layout: a header, the names of the regions and of the
+# instance types, then a float32 price per region and instance type, NaN
+# when there is none
+ONDEMAND_MAGIC = b'SBOTODP\0'
+ONDEMAND_FORMAT_VERSION = 1
+ONDEMAND_HEADER = struct.Struct('<8sHHI')
+ONDEMAND_NAME = struct.Struct('<32s')
+
+
+def pack_ondemand_prices(prices, regions, instance_types):
+    """
+    prices is a dict {(amazon_region, instance_type): price per hour}
+    Return the on-demand prices as bytes
+    """
+    table = array.array('f', [
+        prices.get((region, instance_type), float('nan'))
+        for region in regions for instance_type in instance_types])
+    if sys.byteorder != 'little':
+        table.byteswap()
+    return b''.join(
+        [ONDEMAND_HEADER.pack(ONDEMAND_MAGIC, ONDEMAND_FORMAT_VERSION,
+                              len(regions), len(instance_types))] +
+        [CATALOG_REGION.pack(region.encode('ascii')) for region in regions] +
+        [ONDEMAND_NAME.pack(instance_type.encode('ascii'))
+         for instance_type in instance_types] +
+        [table.tobytes()])
+
+
+class OnDemandPrices(object):
+    """
+    On-demand price per hour of the instance types in each region, looked
+    up by position in a flat table.
+    """
+
+    def __init__(self, buffer):
+        magic, format_version, region_count, type_count = (
+            ONDEMAND_HEADER.unpack_from(buffer, 0))
+        if (magic != ONDEMAND_MAGIC or
+                format_version != ONDEMAND_FORMAT_VERSION):
+            raise ValueError('Unsupported on-demand prices')
+        offset = ONDEMAND_HEADER.size
+        regions = []
+        for _ in range(region_count):
+            regions.append(CATALOG_REGION.unpack_from(buffer, offset)[0]
+                           .rstrip(b'\0').decode('ascii'))
+            offset += CATALOG_REGION.size
+        instance_types = []
+        for _ in range(type_count):
+            instance_types.append(ONDEMAND_NAME.unpack_from(buffer, offset)[0]
+                                  .rstrip(b'\0').decode('ascii'))
+            offset += ONDEMAND_NAME.size
+        self._regions = {region: i for i, region in enumerate(regions)}
+        self._instance_types = {instance_type: i for i, instance_type
+                                in enumerate(instance_types)}
+        self._table = array.array('f')
+        self._table.frombytes(buffer[offset:])
+        if sys.byteorder != 'little':
+            self._table.byteswap()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as prices_file:
+            return cls(prices_file.read())
+
+    def __len__(self):
+        return sum(1 for price in self._table if price == price)
+
+    def get(self, amazon_region, instance_type):
+        """
+        Return the on-demand price per hour, None when it is not known
+        """
+        region = self._regions.get(amazon_region)
+        position = self._instance_types.get(instance_type)
+        if region is None or position is None:
+            return None
+        price = self._table[region * len(self._instance_types) + position]
+        # NaN is the only value not equal to itself, and the prices of the
+        # price list have at most 6 decimals
+        return round(price, 6) if price == price else None
+
+
+_ondemand_prices = None
+
+
+def get_ondemand_prices():
+    """
+    Return the on-demand prices, read from ONDEMAND_PATH on first use, None
+    when the file is missing
+    """
+    global _ondemand_prices
+    if _ondemand_prices is None and os.path.exists(ONDEMAND_PATH):
+        _ondemand_prices = OnDemandPrices.from_file(ONDEMAND_PATH)
+    return _ondemand_prices
+
 
 # --- Helpers that build all of the responses ---
 
@@ -145,39 +1124,197 @@ def delegate(session_attributes, slots):
 
 # --- Helper Functions ---
 
+def normalize_instance_type(instance_type):
+    """
+    Return the instance type the slot value stands for, None if unknown
+    """
+    return get_catalog().names.lookup(instance_type)
+
+
+def unknown_instance_type_message(instance_type):
+    """
+    Return the message asking again for an unknown instance type, with the
+    instance type it may be a typo of
+    """
+    suggestion = get_catalog().names.suggest(instance_type)
+    if suggestion is not None:
+        return (
+            'We currently do not support {} as a valid instance type. '
+            'Did you mean {}?'.format(instance_type, suggestion)
+        )
+    return (
+        'We currently do not support {} as a valid instance type. '
+        'Can you try a different instance type?'.format(instance_type)
+    )
+
+
+def unknown_amazon_region_message(amazon_region, alternative=''):
+    """
+    Return the message asking again for an unknown region, with the region
+    it may be a typo of
+    """
+    suggestion = get_catalog().region_names.suggest(amazon_region)
+    if suggestion is not None:
+        return (
+            'We currently do not support {} as a valid Amazon region. '
+            'Did you mean {}?'.format(amazon_region, suggestion)
+        )
+    return (
+        'We currently do not support {} as a valid Amazon region. '
+        'Can you try a different Amazon region{}?'.format(
+            amazon_region, alternative)
+    )
+
+
+def normalize_amazon_region(amazon_region):
+    """
+    Return the region code the slot value stands for, None if unknown
+    """
+    if is_any_region(amazon_region):
+        return ANY_REGION
+    return get_catalog().region_names.lookup(amazon_region)
+
+
+def is_any_region(amazon_region):
+    """
+    It's any region if it is one of ANY_REGION_NAMES
+    """
+    key = squash(amazon_region or '')
+    return any(key == squash(name) for name in ANY_REGION_NAMES)
+
+
+def normalize_memory(memory):
+    """
+    Return the slot value in GB, e.g. "16 GB" for "16gb" or "16384 MB",
+    None if it is not an amount of memory
+    """
+    memory_gb = parse_memory_gb(memory)
+    return None if memory_gb is None else '{:g} GB'.format(memory_gb)
+
+
+def normalize_slots(slots):
+    """
+    Replace in place the InstanceType, AmazonRegion and Memory slot values
+    with the value they stand for, so that Lex does not ask for them again
+    """
+    if not slots:
+        return
+    for name, normalize in (('InstanceType', normalize_instance_type),
+                            ('AmazonRegion', normalize_amazon_region),
+                            ('Memory', normalize_memory)):
+        value = slots.get(name)
+        if not value:
+            continue
+        normalized = normalize(value)
+        if normalized is not None and normalized != value:
+            logger.debug('slot %s=%s corrected to %s', name, value,
+                         normalized)
+            increment('corrected_slots')
+            slots[name] = normalized
+
+
 def isvalid_instance_type(instance_type):
-    instance_types = INSTANCE_TYPES.keys()
-    return instance_type.lower() in instance_types
+    return normalize_instance_type(instance_type) is not None
 
 
 def isvalid_amazon_region(amazon_region):
-    return amazon_region.lower() in AMAZON_REGIONS
+    return (not is_any_region(amazon_region) and
+            normalize_amazon_region(amazon_region) is not None)
 
 
 def isvalid_memory(memory):
     """
-    It's not valid if the memory is expressed in something else than GB
+    It's not valid if it is not an amount in GB, MB or TB
     """
-    invalid_units = ['kb', 'mb', 'tb', 'pt']
-    for unit in invalid_units:
-        if unit in memory.lower():
-            return False
-    return True
+    return parse_memory_gb(memory) is not None
 
 
-def get_instances(cpu, memory):
+def get_instances(cpu, memory, order_by='name'):
     """
     Return a list of instances that fulfill the requirements (CPU and RAM)
     """
-    cpu = int(cpu)
-    memory = int(memory)
-    instances = []
+    return get_catalog().index.query(min_cpu=int(cpu),
+                                     min_memory=float(memory),
+                                     order_by=order_by)
+
+
+def parse_memory(memory):
+    """
+    Return the amount in GB of a Memory slot value, '0' if there is none
+    """
+    memory_gb = parse_memory_gb(memory) if memory else None
+    return '0' if memory_gb is None else '{:g}'.format(memory_gb)
 
-    for instance, resource in INSTANCE_TYPES.iteritems():
-        if resource[0] >= cpu and resource[1] >= memory:
-            instances.append(instance)
 
-    return instances
+def parse_price(price):
+    """
+    Return the price per hour of a MaxPrice slot value, None if it is not
+    a positive amount of dollars
+    """
+    try:
+        price = float(price.strip().lstrip('$').rstrip('$'))
+    except ValueError:
+        return None
+    return price if price > 0 else None
+
+
+def parse_period(period):
+    """
+    Return the timedelta of an ISO-8601 duration, None if it is not valid
+    """
+    match = DURATION_PATTERN.match(period.upper()) if period else None
+    if not match or not any(match.groupdict().values()):
+        return None
+    return datetime.timedelta(**{unit: int(value)
+                                 for unit, value in match.groupdict().items()
+                                 if value})
+
+
+def format_period(period):
+    """
+    Return a timedelta as a readable string, e.g. '2 days', '12 hours' or
+    '30 minutes'
+    """
+    if period.days and not period.seconds:
+        return '{} days'.format(period.days) if period.days > 1 else 'day'
+    minutes = int(period.total_seconds() // 60)
+    if minutes % 60:
+        return '{} minutes'.format(minutes) if minutes > 1 else 'minute'
+    hours = minutes // 60
+    return '{} hours'.format(hours) if hours > 1 else 'hour'
+
+
+def parse_products(product):
+    """
+    Return the list of the product descriptions of a Product slot value,
+    None if one of them is unknown
+    """
+    product_descriptions = []
+    for name in PRODUCT_SEPARATOR.split(product.strip().lower()):
+        product_description = PRODUCT_DESCRIPTIONS.get(name)
+        if product_description is None:
+            return None
+        if product_description not in product_descriptions:
+            product_descriptions.append(product_description)
+    return product_descriptions
+
+
+def get_product_descriptions(slots):
+    """
+    Return the product descriptions asked for, Linux by default
+    """
+    product = slots.get('Product') if slots else None
+    return (parse_products(product) if product else None) or [
+        DEFAULT_PRODUCT_DESCRIPTION]
+
+
+def get_ranking(slots):
+    """
+    Return the resource the prices are divided by before ranking them,
+    None to rank by price
+    """
+    ranking = slots.get('Ranking') if slots else None
+    return RANKINGS.get(ranking.strip().lower()) if ranking else None
 
 
 def build_validation_result(isvalid, violated_slot, message_content):
@@ -188,27 +1325,55 @@ def build_validation_result(isvalid, violated_slot, message_content):
     }
 
 
+def validate_product(product, allow_several=False):
+    """
+    Return the validation result of the Product slot if it is not valid
+    """
+    product_descriptions = parse_products(product)
+    if not product_descriptions:
+        message = (
+            'We currently do not support {} as a product. Can you choose '
+            'between Linux, Windows, SUSE and Red Hat?'.format(product)
+        )
+        return build_validation_result(False, 'Product', message)
+
+    if len(product_descriptions) > 1 and not allow_several:
+        message = 'Which one of these products would you like?'
+        return build_validation_result(False, 'Product', message)
+
+    return None
+
+
+@timed
 def validate_get_current_spot_price(slots):
     instance_type = slots.get('InstanceType') if slots else None
     amazon_region = slots.get('AmazonRegion') if slots else None
+    product = slots.get('Product') if slots else None
 
     if instance_type and not isvalid_instance_type(instance_type):
-        message = (
-            'We currently do not support {} as a valid instance type. '
-            'Can you try a different instance type?'.format(instance_type)
-        )
+        message = unknown_instance_type_message(instance_type)
         return build_validation_result(False, 'InstanceType', message)
 
     if amazon_region and not isvalid_amazon_region(amazon_region):
-        message = (
-            'We currently do not support {} as a valid Amazon region. '
-            'Can you try a different Amazon region?'.format(amazon_region)
-        )
+        message = unknown_amazon_region_message(amazon_region)
         return build_validation_result(False, 'AmazonRegion', message)
 
-    # check if that instance type is available as spot instance in that region
+    if product:
+        validation_result = validate_product(product, allow_several=True)
+        if validation_result:
+            return validation_result
+
+    # check if that instance type is available as spot instance in that
+    # region, unless its prices are not loaded yet or EC2 is failing there
     if (instance_type and amazon_region and
-            not get_price_history([instance_type], amazon_region)):
+            not is_region_degraded(amazon_region)):
+        spot_prices_results = get_price_history_by_product(
+            [instance_type], amazon_region, get_product_descriptions(slots))
+    else:
+        spot_prices_results = {}
+    if (spot_prices_results and
+            None not in spot_prices_results.values() and
+            not any(spot_prices_results.values())):
         message = (
             'I am afraid I cannot get this information. '
             '{} might not be available as a spot instance in {}. Please '
@@ -219,137 +1384,1704 @@ def validate_get_current_spot_price(slots):
     return {'isValid': True}
 
 
+@timed
 def validate_get_cheapest_spot_price(slots):
     amazon_region = slots.get('AmazonRegion') if slots else None
     memory = slots.get('Memory') if slots else None
+    product = slots.get('Product') if slots else None
+    ranking = slots.get('Ranking') if slots else None
 
-    if amazon_region and not isvalid_amazon_region(amazon_region):
+    if (amazon_region and not is_any_region(amazon_region) and
+            not isvalid_amazon_region(amazon_region)):
+        message = unknown_amazon_region_message(amazon_region,
+                                                ', or anywhere')
+        return build_validation_result(False, 'AmazonRegion', message)
+
+    if memory and not isvalid_memory(memory):
         message = (
-            'We currently do not support {} as a valid Amazon region. '
-            'Can you try a different Amazon region?'.format(amazon_region)
+            'We did not understand {} as an amount of memory. '
+            'How much memory do you require in GB?'.format(memory)
+        )
+        return build_validation_result(False, 'Memory', message)
+
+    if product:
+        validation_result = validate_product(product)
+        if validation_result:
+            return validation_result
+
+    if ranking and ranking.strip().lower() not in RANKINGS:
+        message = (
+            'We currently do not support ranking by {}. Should I rank them by '
+            'price, price per vCPU or price per GB?'.format(ranking)
         )
+        return build_validation_result(False, 'Ranking', message)
+
+    return {'isValid': True}
+
+
+@timed
+def validate_get_cheapest_region(slots):
+    instance_type = slots.get('InstanceType') if slots else None
+    product = slots.get('Product') if slots else None
+
+    if instance_type and not isvalid_instance_type(instance_type):
+        message = unknown_instance_type_message(instance_type)
+        return build_validation_result(False, 'InstanceType', message)
+
+    if product:
+        validation_result = validate_product(product)
+        if validation_result:
+            return validation_result
+
+    return {'isValid': True}
+
+
+@timed
+def validate_get_price_history(slots):
+    instance_type = slots.get('InstanceType') if slots else None
+    amazon_region = slots.get('AmazonRegion') if slots else None
+    period = slots.get('Period') if slots else None
+    product = slots.get('Product') if slots else None
+
+    if instance_type and not isvalid_instance_type(instance_type):
+        message = unknown_instance_type_message(instance_type)
+        return build_validation_result(False, 'InstanceType', message)
+
+    if amazon_region and not isvalid_amazon_region(amazon_region):
+        message = unknown_amazon_region_message(amazon_region)
         return build_validation_result(False, 'AmazonRegion', message)
 
+    if period and not parse_period(period):
+        message = (
+            'I did not understand this period. '
+            'Over how many days or weeks would you like the price history?'
+        )
+        return build_validation_result(False, 'Period', message)
+
+    if product:
+        validation_result = validate_product(product)
+        if validation_result:
+            return validation_result
+
+    return {'isValid': True}
+
+
+@timed
+def validate_get_instance_types(slots):
+    memory = slots.get('Memory') if slots else None
+
     if memory and not isvalid_memory(memory):
         message = (
-            'We currently only support GB as a memory unit. '
-            'How much memory do you require in GB?'
+            'We did not understand {} as an amount of memory. '
+            'How much memory do you require in GB?'.format(memory)
         )
         return build_validation_result(False, 'Memory', message)
 
     return {'isValid': True}
 
 
-def validate_get_instance_types(slots):
+@timed
+def validate_watch_spot_price(slots):
+    instance_type = slots.get('InstanceType') if slots else None
+    amazon_region = slots.get('AmazonRegion') if slots else None
     memory = slots.get('Memory') if slots else None
+    max_price = slots.get('MaxPrice') if slots else None
+    product = slots.get('Product') if slots else None
+
+    if instance_type and not isvalid_instance_type(instance_type):
+        message = unknown_instance_type_message(instance_type)
+        return build_validation_result(False, 'InstanceType', message)
+
+    if amazon_region and not isvalid_amazon_region(amazon_region):
+        message = unknown_amazon_region_message(amazon_region)
+        return build_validation_result(False, 'AmazonRegion', message)
 
     if memory and not isvalid_memory(memory):
         message = (
-            'We currently only support GB as a memory unit. '
-            'How much memory do you require in GB?'
+            'We did not understand {} as an amount of memory. '
+            'How much memory do you require in GB?'.format(memory)
         )
         return build_validation_result(False, 'Memory', message)
 
+    if max_price and parse_price(max_price) is None:
+        message = (
+            'We did not understand {} as a price. Below which price per '
+            'hour (in $)?'.format(max_price)
+        )
+        return build_validation_result(False, 'MaxPrice', message)
+
+    if product:
+        validation_result = validate_product(product)
+        if validation_result:
+            return validation_result
+
     return {'isValid': True}
 
 
+@timed
+def validate_get_spot_savings(slots):
+    instance_type = slots.get('InstanceType') if slots else None
+    amazon_region = slots.get('AmazonRegion') if slots else None
+
+    if instance_type and not isvalid_instance_type(instance_type):
+        message = unknown_instance_type_message(instance_type)
+        return build_validation_result(False, 'InstanceType', message)
+
+    if amazon_region and not isvalid_amazon_region(amazon_region):
+        message = unknown_amazon_region_message(amazon_region)
+        return build_validation_result(False, 'AmazonRegion', message)
+
+    ondemand_prices = get_ondemand_prices()
+    if (instance_type and amazon_region and ondemand_prices is not None and
+            ondemand_prices.get(amazon_region, instance_type) is None):
+        message = (
+            'I do not know the on-demand price of {} in {}. Please enter '
+            'another instance type'.format(instance_type, amazon_region)
+        )
+        return build_validation_result(False, 'InstanceType', message)
+
+    return {'isValid': True}
+
+
+""" --- Cache of the spot prices --- """
+
+
+class SpotPriceCache(object):
+    """
+    Thread-safe LRU cache whose entries expire ttl seconds after their
+    value was fetched.
+    Keys are (amazon_region, product_description), values RegionSnapshot.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                # expired entries are kept until evicted, for get_stale
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_stale(self, key, max_age):
+        """
+        Return the value even if it expired, unless older than max_age
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > max_age:
+                return None
+            return entry[1]
+
+    def put(self, key, value, fetched_at=None):
+        """
+        Add the value fetched at fetched_at (now by default), unless the
+        cache holds one fetched later
+        """
+        fetched_at = fetched_at or time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > fetched_at:
+                return
+            self._entries[key] = (fetched_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+spot_price_cache = SpotPriceCache(SPOT_PRICE_CACHE_TTL, SPOT_PRICE_CACHE_SIZE)
+# downsampled price histories, keyed by (amazon_region, instance_type,
+# product_description, period)
+price_trend_cache = SpotPriceCache(SPOT_PRICE_CACHE_TTL,
+                                   SPOT_PRICE_CACHE_SIZE)
+
+
 """ --- Backend function getting the requested information --- """
 
 
-def call_spot_price_api(instance_types, amazon_region):
-    client = boto3.client('ec2', region_name=amazon_region)
+def get_ec2_client(amazon_region):
+    """
+    Return the EC2 client of the region, creating it on first use.
+    Warm containers reuse the client and its connection pool.
+    """
+    client = _ec2_clients.get(amazon_region)
+    if client is not None:
+        with _ec2_client_stats_lock:
+            EC2_CLIENT_STATS['reused'] += 1
+        return client
+
+    with _ec2_clients_lock:
+        client = _ec2_clients.get(amazon_region)
+        if client is None:
+            boto3 = import_module('boto3')
+            config = import_module('botocore.config').Config(
+                **EC2_CLIENT_OPTIONS)
+            client = boto3.client('ec2', region_name=amazon_region,
+                                  config=config)
+            _ec2_clients[amazon_region] = client
+            created = True
+        else:
+            created = False
+    with _ec2_client_stats_lock:
+        EC2_CLIENT_STATS['created' if created else 'reused'] += 1
+    return client
+
+
+class RegionUnavailable(Exception):
+    """
+    The region was not called: it is failing, or its rate limit leaves no
+    time to call it within the budget
+    """
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket refilled with rate tokens per second, holding
+    at most burst tokens
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """
+        Take a token, waiting for it at most timeout seconds.
+        Return False, without taking it, when it would come too late.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            # a negative count is the tokens promised to the waiting threads
+            wait = max(1 - self._tokens, 0) / self.rate
+            if timeout is not None and wait > timeout:
+                return False
+            self._tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+class CircuitBreaker(object):
+    """
+    Closed while the calls succeed. After `failures` failures in a row it
+    opens for `cooldown` seconds, then lets a single call try again: its
+    success closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        with self._lock:
+            return (self._opened_at is not None and
+                    time.monotonic() - self._opened_at < self.cooldown)
+
+    def is_failing(self):
+        """
+        Return True when the last call failed, or while the breaker is open
+        """
+        with self._lock:
+            return self._failures > 0 or (
+                self._opened_at is not None and
+                time.monotonic() - self._opened_at < self.cooldown)
+
+    def allow(self):
+        """
+        Return True if a call can be made
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if (time.monotonic() - self._opened_at < self.cooldown or
+                    self._trial):
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._failures >= self.failures:
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """
+        Give up the call allowed without making it
+        """
+        with self._lock:
+            self._trial = False
+
+
+def get_region_guards(amazon_region):
+    """
+    Return the tuple (TokenBucket, CircuitBreaker) of the region, shared by
+    the invocations of the container
+    """
+    guards = _region_guards.get(amazon_region)
+    if guards is None:
+        with _region_guards_lock:
+            guards = _region_guards.setdefault(
+                amazon_region, (TokenBucket(EC2_RATE, EC2_BURST),
+                                CircuitBreaker(CIRCUIT_FAILURES,
+                                               CIRCUIT_COOLDOWN)))
+    return guards
+
+
+def is_region_degraded(amazon_region):
+    """
+    Return True when the last call to the region failed, or while its
+    circuit breaker is open
+    """
+    return get_region_guards(amazon_region)[1].is_failing()
+
+
+def call_ec2(amazon_region, operation, **params):
+    """
+    Call the operation of the EC2 client of the region, paced by the rate
+    limiter of the region and guarded by its circuit breaker. Throttled and
+    transient errors are retried with jittered exponential backoff, within
+    the budget of the invocation.
+    Raise RegionUnavailable when the region is not called.
+    """
+    client = get_ec2_client(amazon_region)
+    limiter, breaker = get_region_guards(amazon_region)
+    if not breaker.allow():
+        increment('short_circuits')
+        raise RegionUnavailable('{} is failing'.format(amazon_region))
+
+    for attempt in range(EC2_RETRIES + 1):
+        if not limiter.acquire(remaining_budget()):
+            breaker.release()
+            raise RegionUnavailable('{} is rate limited'.format(amazon_region))
+        try:
+            response = getattr(client, operation)(**params)
+        except Exception as e:
+            error = getattr(e, 'response', None) or {}
+            code = error.get('Error', {}).get('Code')
+            if code in THROTTLING_ERRORS:
+                increment('throttles')
+            # full jitter spreads the retries of the concurrent callers
+            delay = random.uniform(
+                0, min(EC2_BACKOFF_MAX, EC2_BACKOFF * 2 ** attempt))
+            budget = remaining_budget()
+            if (code not in RETRYABLE_ERRORS or attempt == EC2_RETRIES or
+                    (budget is not None and delay >= budget)):
+                breaker.record_failure()
+                raise
+            logger.debug('%s %s failed with %s, retry in %.3fs',
+                         amazon_region, operation, code, delay)
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return response
 
+
+def iter_spot_price_pages(amazon_region, instance_types=None,
+                          product_descriptions=None, start_time=None,
+                          end_time=None):
+    """
+    Yield the pages of describe_spot_price_history, following NextToken.
+    Without instance_types, all the instance types of the region are returned.
+    """
+    params = {
+        'StartTime': start_time or datetime.datetime.utcnow(),
+        'ProductDescriptions': (product_descriptions or
+                                [DEFAULT_PRODUCT_DESCRIPTION])
+    }
+    if end_time:
+        params['EndTime'] = end_time
+    if instance_types:
+        params['InstanceTypes'] = list(instance_types)
+
+    # pages are requested one by one, so that a throttled page is retried
+    # without starting over
+    while True:
+        page = call_ec2(amazon_region, 'describe_spot_price_history',
+                        **params)
+        headers = page.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        increment('api_calls')
+        increment('bytes_returned', int(headers.get('content-length', 0)))
+        yield page
+        if not page.get('NextToken'):
+            return
+        params['NextToken'] = page['NextToken']
+
+
+@timed
+def fetch_spot_prices(amazon_region, product_descriptions=None):
+    """
+    Return the current spot prices of every instance type of the region in
+    all the pages, as a single response, None on error
+    """
+    spot_prices = []
     try:
-        response = client.describe_spot_price_history(
-            StartTime=datetime.datetime.utcnow(),
-            InstanceTypes=instance_types,
-            ProductDescriptions=['Linux/UNIX (Amazon VPC)']
-        )
+        for page in iter_spot_price_pages(amazon_region, None,
+                                          product_descriptions):
+            spot_prices.extend(page['SpotPriceHistory'])
+    except RegionUnavailable as e:
+        logger.warning('%s', e)
+        return None
     except Exception as e:
         logger.exception(e)
-        return []
+        return None
 
-    return response
+    return {'SpotPriceHistory': spot_prices}
+
+
+SpotPrice = collections.namedtuple(
+    'SpotPrice', ['instance_type', 'availability_zone', 'price', 'timestamp'])
+
+
+class RegionSnapshot(object):
+    """
+    Current spot prices of every instance type of a region, indexed by
+    instance type and then availability zone.
+    """
+
+    def __init__(self, amazon_region, product_description, fetched_at=None):
+        self.amazon_region = amazon_region
+        self.product_description = product_description
+        self.fetched_at = fetched_at or time.time()
+        self.index = {}
+        self.availability_zones = set()
+        self._matrix = None
+
+    def add(self, spot_price):
+        self._matrix = None
+        zones = self.index.setdefault(spot_price.instance_type, {})
+        current = zones.get(spot_price.availability_zone)
+        # older prices can be returned too, we only keep the latest one
+        if current is None or spot_price.timestamp > current.timestamp:
+            zones[spot_price.availability_zone] = spot_price
+        self.availability_zones.add(spot_price.availability_zone)
+
+    def __contains__(self, instance_type):
+        return instance_type in self.index
+
+    def prices(self, instance_types=None):
+        """
+        Return the SpotPrice of the instance types (all of them by default)
+        sorted by instance type and availability zone
+        """
+        if instance_types is None:
+            instance_types = self.index.keys()
+        spot_prices = []
+        for instance_type in sorted(instance_types):
+            zones = self.index.get(instance_type)
+            if zones:
+                spot_prices.extend(zones[az] for az in sorted(zones))
+        return spot_prices
+
+    @property
+    def matrix(self):
+        """
+        PriceMatrix of the snapshot, built on first use
+        """
+        if self._matrix is None:
+            self._matrix = PriceMatrix.from_snapshot(self)
+        return self._matrix
+
+
+class PriceMatrix(object):
+    """
+    Spot prices in columns: one row per (region, availability zone,
+    instance type) with the price, the timestamp (seconds since epoch) and
+    integer codes of the instance type (its position in the catalog), the
+    availability zone and the region.
+    The vCPU and memory of the rows come from the columns of the catalog.
+    Without numpy, the snapshots of the rows are ranked instead.
+    """
+
+    def __init__(self):
+        self.prices = array.array('d')
+        self.timestamps = array.array('d')
+        self.types = array.array('i')
+        self.zones = array.array('i')
+        self.regions = array.array('i')
+        self.zone_names = []
+        self.region_names = []
+        self.snapshots = []
+
+    def __len__(self):
+        return len(self.prices)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        matrix = cls()
+        matrix.region_names.append(snapshot.amazon_region)
+        matrix.snapshots.append(snapshot)
+        positions = get_catalog().columns.positions
+        for instance_type in sorted(snapshot.index):
+            position = positions.get(instance_type)
+            if position is None:
+                # without vCPU and memory, it can not match any query
+                continue
+            zones = snapshot.index[instance_type]
+            for availability_zone in sorted(zones):
+                if availability_zone not in matrix.zone_names:
+                    matrix.zone_names.append(availability_zone)
+                spot_price = zones[availability_zone]
+                matrix.prices.append(spot_price.price)
+                matrix.timestamps.append(_epoch(spot_price.timestamp))
+                matrix.types.append(position)
+                matrix.zones.append(
+                    matrix.zone_names.index(availability_zone))
+                matrix.regions.append(0)
+        return matrix
+
+    @classmethod
+    def concatenate(cls, matrices):
+        """
+        Return a PriceMatrix of the rows of the matrices
+        """
+        result = cls()
+        for matrix in matrices:
+            zone_offset = len(result.zone_names)
+            region_offset = len(result.region_names)
+            result.prices.extend(matrix.prices)
+            result.timestamps.extend(matrix.timestamps)
+            result.types.extend(matrix.types)
+            result.zones.extend(code + zone_offset for code in matrix.zones)
+            result.regions.extend(code + region_offset
+                                  for code in matrix.regions)
+            result.zone_names.extend(matrix.zone_names)
+            result.region_names.extend(matrix.region_names)
+            result.snapshots.extend(matrix.snapshots)
+        return result
+
+    def cheapest(self, min_cpu=0, min_memory=0, ranking=None,
+                 top=CHEAPEST_TOP_K):
+        """
+        Return the tuples [(instance_type, price, availability_zone,
+        amazon_region)] of the top instance types with at least min_cpu
+        vCPU and min_memory GB, each in its cheapest row, ranked by price or
+        by price per vCPU ('cpu') or GB ('memory')
+        """
+        if not len(self):
+            return []
+        numpy = optional_numpy()
+        if numpy is None:
+            return self._cheapest_snapshots(min_cpu, min_memory, ranking, top)
+        columns = get_catalog().columns
+        rows = self._cheapest_rows_numpy(numpy, columns, min_cpu, min_memory,
+                                         ranking, top)
+        return [(columns.names[self.types[row]], self.prices[row],
+                 self.zone_names[self.zones[row]],
+                 self.region_names[self.regions[row]])
+                for row in rows]
+
+    def _cheapest_rows_numpy(self, numpy, columns, min_cpu, min_memory,
+                             ranking, top):
+        prices = numpy.frombuffer(self.prices, dtype=numpy.float64)
+        types = numpy.frombuffer(self.types, dtype=numpy.intc)
+        cpus = numpy.frombuffer(columns.cpus, dtype=numpy.float64)[types]
+        memory = numpy.frombuffer(columns.memory, dtype=numpy.float64)[types]
+        rows = numpy.flatnonzero((cpus >= min_cpu) & (memory >= min_memory) &
+                                 (cpus > 0) & (memory > 0))
+        if not len(rows):
+            return []
+        scores = prices[rows]
+        if ranking == 'cpu':
+            scores = scores / cpus[rows]
+        elif ranking == 'memory':
+            scores = scores / memory[rows]
+        # sorted by score then instance type, the first row of an instance
+        # type is its cheapest, and the first rows are the top ones
+        order = rows[numpy.lexsort((types[rows], scores))]
+        _, first = numpy.unique(types[order], return_index=True)
+        return order[numpy.sort(first)[:top]].tolist()
+
+    def _cheapest_snapshots(self, min_cpu, min_memory, ranking, top):
+        # the top instance types across the regions are among the top ones
+        # of each region, where they are the cheapest
+        instance_types = get_catalog().index.query(min_cpu=min_cpu,
+                                                   min_memory=min_memory)
+        regions = {}
+        spot_prices = []
+        for snapshot in self.snapshots:
+            for instance_type, price, availability_zone in rank_cheapest(
+                    snapshot.prices(instance_types), ranking, top):
+                regions[availability_zone] = snapshot.amazon_region
+                spot_prices.append(SpotPrice(instance_type, availability_zone,
+                                             price, None))
+        return [instance + (regions[instance[2]],)
+                for instance in rank_cheapest(spot_prices, ranking, top)]
+
+
+def load_region_snapshots(amazon_region, product_descriptions):
+    """
+    Pull all the current spot prices of the products in a region with a
+    single paginated request.
+    Return a dict {product_description: RegionSnapshot}, None on error.
+    """
+    response = fetch_spot_prices(amazon_region, product_descriptions)
+    if not response:
+        return None
+
+    snapshots = {product_description: RegionSnapshot(amazon_region,
+                                                     product_description)
+                 for product_description in product_descriptions}
+    for row in response['SpotPriceHistory']:
+        snapshot = snapshots.get(row['ProductDescription'])
+        if snapshot is not None:
+            snapshot.add(SpotPrice(row['InstanceType'],
+                                   row['AvailabilityZone'],
+                                   float(row['SpotPrice']), row['Timestamp']))
+    return snapshots
+
+
+def remaining_budget():
+    """
+    Return the seconds left before the deadline of the invocation,
+    None when there is no deadline
+    """
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+def refresh_region_snapshots(amazon_region, product_descriptions):
+    """
+    Load the snapshots of the products in the region into the cache in the
+    background, with one request for the products not already loading.
+    Return a dict {product_description: future}, the result of the futures
+    being a dict {product_description: RegionSnapshot} or None.
+    """
+    def refresh(products):
+        try:
+            snapshots = load_region_snapshots(amazon_region, products)
+            # errors are not cached, the next question will try again
+            for product_description, snapshot in (snapshots or {}).items():
+                spot_price_cache.put((amazon_region, product_description),
+                                     snapshot, snapshot.fetched_at)
+            return snapshots
+        finally:
+            with _refreshes_lock:
+                for product_description in products:
+                    _refreshes.pop((amazon_region, product_description),
+                                   None)
+
+    futures = {}
+    with _refreshes_lock:
+        missing = []
+        for product_description in product_descriptions:
+            future = _refreshes.get((amazon_region, product_description))
+            if future is None:
+                missing.append(product_description)
+            else:
+                increment('coalesced_calls')
+                futures[product_description] = future
+        if missing:
+            future = _refresh_executor.submit(
+                contextvars.copy_context().run, refresh, missing)
+            for product_description in missing:
+                _refreshes[(amazon_region, product_description)] = future
+                futures[product_description] = future
+    return futures
+
+
+@timed
+def get_region_snapshots(amazon_region, product_descriptions):
+    """
+    Return a dict {product_description: RegionSnapshot or None} of the
+    region, loading in a single request the snapshots that are missing or
+    older than SPOT_PRICE_CACHE_TTL seconds.
+    If the load does not finish within the budget of the invocation, return
+    the expired snapshots (if any) and let the load complete in the
+    background for a later invocation.
+    """
+    snapshots = {}
+    missing = []
+    for product_description in product_descriptions:
+        key = (amazon_region, product_description)
+        snapshot = spot_price_cache.get(key)
+        if snapshot is None:
+            # the scheduled prewarm_handler may have stored it already. A
+            # stored snapshot older than the TTL is only kept for the stale
+            # path, if the load does not finish in time
+            stored = price_store.read_snapshot(amazon_region,
+                                               product_description)
+            if stored is not None:
+                increment('store_hits')
+                spot_price_cache.put(key, stored, stored.fetched_at)
+                if time.time() - stored.fetched_at <= spot_price_cache.ttl:
+                    snapshot = stored
+                    record_snapshot_age(amazon_region, product_description,
+                                        stored.fetched_at)
+        else:
+            increment('cache_hits')
+        if snapshot is None:
+            increment('cache_misses')
+            missing.append(product_description)
+        snapshots[product_description] = snapshot
+    if not missing:
+        return snapshots
+
+    futures = refresh_region_snapshots(amazon_region, missing)
+    for product_description, future in futures.items():
+        try:
+            loaded = future.result(timeout=remaining_budget())
+        except concurrent.futures.TimeoutError:
+            increment('deadline_exceeded')
+            loaded = None
+        if loaded:
+            snapshots[product_description] = loaded.get(product_description)
+            continue
+        # the region is slow or failing, the last prices are better than none
+        snapshot = spot_price_cache.get_stale(
+            (amazon_region, product_description), SPOT_PRICE_STALE_MAX_AGE)
+        if snapshot is not None:
+            increment('stale_answers')
+            record_snapshot_age(amazon_region, product_description,
+                                snapshot.fetched_at)
+        snapshots[product_description] = snapshot
+    return snapshots
+
+
+def record_snapshot_age(amazon_region, product_description, fetched_at):
+    """
+    Record the age of the prices of the region that the invocation answers
+    with, when they may not be fresh
+    """
+    stale = _current_stale.get()
+    if stale is not None:
+        stale[(amazon_region, product_description)] = (
+            time.time() - fetched_at)
+
+
+def get_region_snapshot(amazon_region,
+                        product_description=DEFAULT_PRODUCT_DESCRIPTION):
+    """
+    Return the snapshot of the region for a single product
+    """
+    return get_region_snapshots(amazon_region,
+                                [product_description])[product_description]
+
+
+# --- Store of the precomputed prices ---
+
+
+class SQLiteStore(object):
+    """
+    SQLite file shared by the threads of the container, created with the
+    tables of SCHEMA on first write
+    """
+
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self, create=False):
+        """
+        Return the connection, None if the store was never written
+        """
+        if self._connection is None:
+            if not create and not os.path.exists(self.path):
+                return None
+            sqlite3 = import_module('sqlite3')
+            self._connection = sqlite3.connect(self.path,
+                                               check_same_thread=False)
+            for statement in self.SCHEMA:
+                self._connection.execute(statement)
+        return self._connection
+
+
+class PriceStore(SQLiteStore):
+    """
+    SQLite file holding the snapshots of the regions and the cheapest
+    instances for common thresholds, written by prewarm_handler.
+    Entries older than max_age are ignored.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS snapshots ('
+        ' region TEXT, product TEXT, fetched_at REAL,'
+        ' PRIMARY KEY (region, product)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS spot_prices ('
+        ' region TEXT, product TEXT, instance_type TEXT, zone TEXT,'
+        ' price REAL, timestamp REAL,'
+        ' PRIMARY KEY (region, product, instance_type, zone)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS cheapest ('
+        ' region TEXT, product TEXT, cpu INTEGER, memory INTEGER,'
+        ' position INTEGER, instance_type TEXT, price REAL, zone TEXT,'
+        ' PRIMARY KEY (region, product, cpu, memory, position))'
+        ' WITHOUT ROWID',
+    )
+
+    def __init__(self, path, max_age):
+        super(PriceStore, self).__init__(path)
+        self.max_age = max_age
+
+    def _fetched_at(self, connection, amazon_region, product_description):
+        row = connection.execute(
+            'SELECT fetched_at FROM snapshots WHERE region = ? AND '
+            'product = ?', (amazon_region, product_description)).fetchone()
+        if row is None or time.time() - row[0] > self.max_age:
+            return None
+        return row[0]
+
+    def write(self, snapshot, cheapest):
+        """
+        Replace the prices of the region of the snapshot. cheapest is a dict
+        {(cpu, memory): [(instance_type, price, availability_zone)]}
+        """
+        region = snapshot.amazon_region
+        product = snapshot.product_description
+        with self._lock:
+            connection = self._connect(create=True)
+            with connection:
+                for table in ('snapshots', 'spot_prices', 'cheapest'):
+                    connection.execute(
+                        'DELETE FROM {} WHERE region = ? AND product = ?'
+                        ''.format(table), (region, product))
+                connection.executemany(
+                    'INSERT INTO spot_prices VALUES (?, ?, ?, ?, ?, ?)',
+                    ((region, product, spot_price.instance_type,
+                      spot_price.availability_zone, spot_price.price,
+                      _epoch(spot_price.timestamp))
+                     for spot_price in snapshot.prices()))
+                connection.executemany(
+                    'INSERT INTO cheapest VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((region, product, cpu, memory, position) + instance
+                     for (cpu, memory), instances in cheapest.items()
+                     for position, instance in enumerate(instances)))
+                connection.execute(
+                    'INSERT INTO snapshots VALUES (?, ?, ?)',
+                    (region, product, snapshot.fetched_at))
+
+    def read_snapshot(self, amazon_region, product_description):
+        """
+        Return the stored RegionSnapshot, None if missing or too old
+        """
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return None
+            fetched_at = self._fetched_at(connection, amazon_region,
+                                          product_description)
+            if fetched_at is None:
+                return None
+            rows = connection.execute(
+                'SELECT instance_type, zone, price, timestamp '
+                'FROM spot_prices WHERE region = ? AND product = ?',
+                (amazon_region, product_description)).fetchall()
+
+        snapshot = RegionSnapshot(amazon_region, product_description,
+                                  fetched_at)
+        for instance_type, zone, price, timestamp in rows:
+            snapshot.add(SpotPrice(
+                instance_type, zone, price,
+                datetime.datetime.fromtimestamp(timestamp,
+                                                datetime.timezone.utc)))
+        return snapshot
+
+    def read_cheapest(self, amazon_region, product_description, cpu,
+                      memory):
+        """
+        Return a tuple (fetched_at, cheapest) of the stored cheapest
+        instances for the thresholds, None if they were not precomputed or
+        are too old
+        """
+        if (cpu, memory) not in PRECOMPUTED_THRESHOLDS:
+            return None
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return None
+            fetched_at = self._fetched_at(connection, amazon_region,
+                                          product_description)
+            if fetched_at is None:
+                return None
+            rows = connection.execute(
+                'SELECT instance_type, price, zone FROM cheapest '
+                'WHERE region = ? AND product = ? AND cpu = ? AND memory = ? '
+                'ORDER BY position',
+                (amazon_region, product_description, cpu, memory)).fetchall()
+        return fetched_at, [tuple(row) for row in rows]
+
+
+price_store = PriceStore(PRICE_STORE_PATH, PRICE_STORE_MAX_AGE)
+
+
+class WatchStore(SQLiteStore):
+    """
+    SQLite file holding the price watches of the users, and the alerts
+    they triggered until the users are told.
+    A watch has a row per instance type it covers, keyed by (region,
+    product, instance type, max price): a price drop only reads the
+    watches it triggers, however many watches there are.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS watches ('
+        ' region TEXT, product TEXT, instance_type TEXT, max_price REAL,'
+        ' watch_id TEXT, user_id TEXT, expires_at REAL,'
+        ' PRIMARY KEY (region, product, instance_type, max_price, watch_id))'
+        ' WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS watched_prices ('
+        ' region TEXT, product TEXT, instance_type TEXT, price REAL,'
+        ' PRIMARY KEY (region, product, instance_type)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS alerts ('
+        ' user_id TEXT, watch_id TEXT, created_at REAL, instance_type TEXT,'
+        ' region TEXT, price REAL, zone TEXT,'
+        ' PRIMARY KEY (user_id, watch_id, created_at)) WITHOUT ROWID',
+    )
+
+    def __init__(self, path, max_age):
+        super(WatchStore, self).__init__(path)
+        self.max_age = max_age
+
+    def add(self, user_id, amazon_region, product_description,
+            instance_types, max_price):
+        """
+        Watch the instance types until the cheapest of them is under
+        max_price in the region. Return the id of the watch.
+        """
+        watch_id = os.urandom(8).hex()
+        expires_at = time.time() + self.max_age
+        with self._lock:
+            connection = self._connect(create=True)
+            with connection:
+                connection.executemany(
+                    'INSERT INTO watches VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    ((amazon_region, product_description, instance_type,
+                      max_price, watch_id, user_id, expires_at)
+                     for instance_type in instance_types))
+        return watch_id
+
+    def products(self):
+        """
+        Return the set of the watched product descriptions
+        """
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return set()
+            return {row[0] for row in connection.execute(
+                'SELECT DISTINCT product FROM watches')}
+
+    def evaluate(self, snapshot):
+        """
+        Diff the cheapest price of each instance type of the snapshot with
+        the one of the previous evaluation. The watches whose max price is
+        between the two trigger an alert.
+        Return the alerts [(user_id, watch_id, instance_type, price,
+        availability_zone)], one per watch.
+        """
+        region = snapshot.amazon_region
+        product = snapshot.product_description
+        cheapest = cheapest_by_instance_type(snapshot.prices())
+
+        now = time.time()
+        alerts = {}
+        with self._lock:
+            connection = self._connect(create=True)
+            with connection:
+                previous = dict(connection.execute(
+                    'SELECT instance_type, price FROM watched_prices '
+                    'WHERE region = ? AND product = ?', (region, product)))
+                # the first evaluation of a region is the reference, the
+                # users were told the prices when they asked for the watch
+                for instance_type, spot_price in (cheapest.items()
+                                                  if previous else ()):
+                    last = previous.get(instance_type, float('inf'))
+                    if spot_price.price >= last:
+                        continue
+                    for watch_id, user_id in connection.execute(
+                            'SELECT watch_id, user_id FROM watches '
+                            'WHERE region = ? AND product = ? AND '
+                            'instance_type = ? AND max_price >= ? AND '
+                            'max_price < ? AND expires_at > ?',
+                            (region, product, instance_type,
+                             spot_price.price, last, now)):
+                        alert = alerts.get(watch_id)
+                        if alert is None or spot_price.price < alert[3]:
+                            alerts[watch_id] = (
+                                user_id, watch_id, instance_type,
+                                spot_price.price,
+                                spot_price.availability_zone)
+
+                connection.execute(
+                    'DELETE FROM watched_prices WHERE region = ? AND '
+                    'product = ?', (region, product))
+                connection.executemany(
+                    'INSERT INTO watched_prices VALUES (?, ?, ?, ?)',
+                    ((region, product, instance_type, spot_price.price)
+                     for instance_type, spot_price in cheapest.items()))
+                connection.executemany(
+                    'INSERT OR REPLACE INTO alerts VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?)',
+                    ((user_id, watch_id, now, instance_type, region, price,
+                      zone)
+                     for user_id, watch_id, instance_type, price, zone
+                     in alerts.values()))
+        return list(alerts.values())
+
+    def pop_alerts(self, user_id):
+        """
+        Return and forget the alerts of the user
+        [(instance_type, region, price, availability_zone)]
+        """
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return []
+            with connection:
+                rows = connection.execute(
+                    'SELECT instance_type, region, price, zone FROM alerts '
+                    'WHERE user_id = ? ORDER BY created_at',
+                    (user_id,)).fetchall()
+                if rows:
+                    connection.execute(
+                        'DELETE FROM alerts WHERE user_id = ?', (user_id,))
+        return [tuple(row) for row in rows]
+
+    def expire(self):
+        """
+        Forget the watches older than max_age
+        """
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return
+            with connection:
+                connection.execute('DELETE FROM watches WHERE expires_at < ?',
+                                   (time.time(),))
+
+
+watch_store = WatchStore(WATCH_STORE_PATH, WATCH_MAX_AGE)
+if (os.environ.get('AWS_LAMBDA_FUNCTION_NAME') and
+        os.path.abspath(WATCH_STORE_PATH).startswith('/tmp/')):
+    logger.warning('WATCH_STORE_PATH %s is in /tmp: the watches are only '
+                   'seen by this container and lost with it',
+                   WATCH_STORE_PATH)
+
+
+def get_snapshot_age(amazon_region,
+                     product_description=DEFAULT_PRODUCT_DESCRIPTION):
+    """
+    Return the age in seconds of the prices of the region if the
+    invocation used them after they expired or from the price store, None
+    otherwise
+    """
+    stale = _current_stale.get()
+    if not stale:
+        return None
+    return stale.get((amazon_region, product_description))
+
+
+def get_spot_prices(instance_types, amazon_region,
+                    product_description=DEFAULT_PRODUCT_DESCRIPTION):
+    """
+    Return the current SpotPrice of the instance types in the region, None
+    when the prices of the region are not loaded (yet)
+    """
+    snapshot = get_region_snapshot(amazon_region, product_description)
+    if snapshot is None:
+        return None
+    return snapshot.prices(instance_types)
 
 
-def get_price_history(instance_type, amazon_region):
-    """Return price history as list of tuples [(price, availability-zone)]"""
-    response = call_spot_price_api(instance_type, amazon_region)
-    return [(float(price['SpotPrice']), price['AvailabilityZone'])
-            for price in response['SpotPriceHistory']]
+def get_price_history(instance_type, amazon_region,
+                      product_description=DEFAULT_PRODUCT_DESCRIPTION):
+    """
+    Return price history as list of tuples [(price, availability-zone)],
+    None when the prices of the region are not loaded (yet)
+    """
+    spot_prices = get_spot_prices(instance_type, amazon_region,
+                                  product_description)
+    if spot_prices is None:
+        return None
+    return [(spot_price.price, spot_price.availability_zone)
+            for spot_price in spot_prices]
 
 
-def get_cheapest_instance(instances, amazon_region):
+def get_price_history_by_product(instance_type, amazon_region,
+                                 product_descriptions):
+    """
+    Return the price history of the products, loaded with a single request,
+    as a dict {product_description: [(price, availability-zone)]}, the
+    value being None when the prices are not loaded (yet)
+    """
+    snapshots = get_region_snapshots(amazon_region, product_descriptions)
+    return {
+        product_description: [
+            (spot_price.price, spot_price.availability_zone)
+            for spot_price in snapshot.prices(instance_type)]
+        if snapshot is not None else None
+        for product_description, snapshot in snapshots.items()
+    }
+
+
+def get_cheapest_instance(instances, amazon_region,
+                          product_description=DEFAULT_PRODUCT_DESCRIPTION,
+                          ranking=None, top=CHEAPEST_TOP_K):
     """
     Return the prices ([isntance_type, price, availability_zone])
-    of the cheapeast instances
+    of the cheapeast instances, None when the prices of the region are not
+    loaded (yet)
     """
     if not instances:
         return []
 
     # get the current spot prices
-    response = call_spot_price_api(instances, amazon_region)
-
-    # we first find the cheapest instance type
-    minimum_price = float('inf')
-    is_instance_type = False
-    for instance in response['SpotPriceHistory']:
-        price = float(instance['SpotPrice'])
-        if price < minimum_price:
-            minimum_price = price
-            is_instance_type = True
-
-    if not is_instance_type:
+    spot_prices = get_spot_prices(instances, amazon_region,
+                                  product_description)
+    if spot_prices is None:
+        return None
+    return rank_cheapest(spot_prices, ranking, top)
+
+
+def cheapest_by_instance_type(spot_prices):
+    """
+    Return a dict {instance_type: SpotPrice} of the SpotPrice of each
+    instance type in its cheapest availability zone
+    """
+    cheapest = {}
+    for spot_price in spot_prices:
+        best = cheapest.get(spot_price.instance_type)
+        if best is None or spot_price.price < best.price:
+            cheapest[spot_price.instance_type] = spot_price
+    return cheapest
+
+
+def rank_cheapest(spot_prices, ranking=None, top=CHEAPEST_TOP_K):
+    """
+    Return the tuples [(instance_type, price, availability_zone)] of the top
+    instance types of the SpotPrice, each in its cheapest availability zone,
+    ranked by price or by price per vCPU ('cpu') or GB ('memory')
+    """
+    cheapest = cheapest_by_instance_type(spot_prices)
+
+    if ranking is None:
+        keys = ((spot_price.price, instance_type)
+                for instance_type, spot_price in cheapest.items())
+    else:
+        catalog = get_catalog()
+        keys = []
+        for instance_type, spot_price in cheapest.items():
+            cores, memory = catalog.resources(instance_type)
+            resource = cores if ranking == 'cpu' else memory
+            if resource:
+                keys.append((spot_price.price / resource, instance_type))
+
+    return [(instance_type, cheapest[instance_type].price,
+             cheapest[instance_type].availability_zone)
+            for _, instance_type in heapq.nsmallest(top, keys)]
+
+
+def get_cheapest_with_at_least(
+        cpu, memory, amazon_region,
+        product_description=DEFAULT_PRODUCT_DESCRIPTION, ranking=None):
+    """
+    Return the cheapest instances with at least cpu vCPU and memory GB,
+    precomputed by prewarm_handler when the thresholds are common ones,
+    they are ranked by price and the cache has no fresh snapshot. Return
+    None when the prices of the region are not loaded (yet)
+    """
+    snapshot = spot_price_cache.get((amazon_region, product_description))
+    if snapshot is not None:
+        increment('cache_hits')
+    elif ranking is None:
+        stored = price_store.read_cheapest(
+            amazon_region, product_description, int(cpu), float(memory))
+        if stored is not None:
+            increment('store_hits')
+            fetched_at, spot_prices_result = stored
+            record_snapshot_age(amazon_region, product_description,
+                                fetched_at)
+            return spot_prices_result
+    if snapshot is None:
+        snapshot = get_region_snapshot(amazon_region, product_description)
+    if snapshot is None:
+        return None
+    return [instance[:3] for instance in snapshot.matrix.cheapest(
+        int(cpu), float(memory), ranking)]
+
+
+def get_cheapest_anywhere(cpu, memory,
+                          product_description=DEFAULT_PRODUCT_DESCRIPTION,
+                          ranking=None, timeout=REGION_TIMEOUT):
+    """
+    Return a tuple (cheapest, missing_regions) where cheapest is a list of
+    tuples [(instance_type, price, availability_zone, amazon_region)] of
+    the cheapest instances with at least cpu vCPU and memory GB across the
+    regions that answered within the timeout
+    """
+    futures = {
+        _region_executor.submit(contextvars.copy_context().run,
+                                get_region_snapshot, region,
+                                product_description): region
+        for region in get_catalog().regions
+    }
+    budget = remaining_budget()
+    if budget is not None:
+        timeout = min(timeout, budget)
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+
+    matrices = []
+    missing_regions = [futures[future] for future in not_done]
+    for future in done:
+        try:
+            snapshot = future.result()
+        except Exception as e:
+            logger.exception(e)
+            snapshot = None
+        if snapshot is None:
+            missing_regions.append(futures[future])
+        else:
+            matrices.append(snapshot.matrix)
+    cheapest = PriceMatrix.concatenate(matrices).cheapest(
+        int(cpu), float(memory), ranking)
+    return cheapest, sorted(missing_regions)
+
+
+def get_prices_by_region(instance_type, amazon_regions=None,
+                         timeout=REGION_TIMEOUT,
+                         product_description=DEFAULT_PRODUCT_DESCRIPTION):
+    """
+    Query the regions concurrently for the prices of an instance type.
+    Return a tuple (prices, missing_regions) where prices is a dict
+    {amazon_region: [(price, availability-zone)]} of the regions that
+    answered within the timeout
+    """
+    if not amazon_regions:
+        # no need to ask the regions where the instance type is not offered
+        info = get_catalog().get(instance_type)
+        amazon_regions = info.regions if info else AMAZON_REGIONS
+    futures = {}
+    for region in amazon_regions:
+        # the spans of the workers go to the metrics of this invocation
+        future = _region_executor.submit(contextvars.copy_context().run,
+                                         get_price_history, [instance_type],
+                                         region, product_description)
+        futures[future] = region
+    budget = remaining_budget()
+    if budget is not None:
+        timeout = min(timeout, budget)
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+
+    prices = {}
+    missing_regions = []
+    for future in done:
+        region = futures[future]
+        try:
+            region_prices = future.result()
+        except Exception as e:
+            logger.exception(e)
+            region_prices = None
+        if region_prices is None:
+            missing_regions.append(region)
+        else:
+            prices[region] = region_prices
+    for future in not_done:
+        # the query keeps running and will fill the cache for next time
+        missing_regions.append(futures[future])
+
+    return prices, sorted(missing_regions)
+
+
+def get_cheapest_region(instance_type, amazon_regions=None,
+                        timeout=REGION_TIMEOUT,
+                        product_description=DEFAULT_PRODUCT_DESCRIPTION):
+    """
+    Return a tuple (cheapest, missing_regions) where cheapest is a list of
+    tuples [(price, amazon_region, availability-zone)] sorted by price,
+    with the cheapest availability zone of each region
+    """
+    prices, missing_regions = get_prices_by_region(
+        instance_type, amazon_regions, timeout, product_description)
+    cheapest = [min(region_prices) + (region,)
+                for region, region_prices in prices.items() if region_prices]
+    cheapest = [(price, region, availability_zone)
+                for price, availability_zone, region in sorted(cheapest)]
+    return cheapest, missing_regions
+
+
+class PriceSeries(object):
+    """
+    Spot price points stored in arrays of doubles rather than boto dicts:
+    timestamps (seconds since epoch) and prices.
+    """
+
+    def __init__(self):
+        self.timestamps = array.array('d')
+        self.prices = array.array('d')
+
+    def extend(self, spot_prices):
+        for row in spot_prices:
+            self.timestamps.append(_epoch(row['Timestamp']))
+            self.prices.append(float(row['SpotPrice']))
+
+    def __len__(self):
+        return len(self.prices)
+
+
+def _epoch(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp.timestamp()
+
+
+@timed
+def load_price_series(instance_type, amazon_region, start_time, end_time,
+                      product_description=DEFAULT_PRODUCT_DESCRIPTION):
+    """
+    Stream the pages of the price history into a PriceSeries, so only one
+    page of boto dicts is in memory at a time
+    """
+    series = PriceSeries()
+    pages = iter_spot_price_pages(amazon_region, [instance_type],
+                                  [product_description],
+                                  start_time=start_time, end_time=end_time)
+    for page in pages:
+        series.extend(page['SpotPriceHistory'])
+    return series
+
+
+def downsample_price_series(series, start, end, buckets=HISTORY_BUCKETS):
+    """
+    Split [start, end] (seconds since epoch) into buckets of equal width.
+    Return a list of tuples [(bucket_start, min, max, mean)]
+    for the buckets that have at least one price
+    """
+    if not len(series):
         return []
+    width = (end - start) / float(buckets)
+
+    numpy = optional_numpy()
+    if numpy is not None:
+        timestamps = numpy.frombuffer(series.timestamps, dtype=numpy.float64)
+        prices = numpy.frombuffer(series.prices, dtype=numpy.float64)
+        index = numpy.clip(((timestamps - start) // width).astype(numpy.intp),
+                           0, buckets - 1)
+        counts = numpy.bincount(index, minlength=buckets)
+        sums = numpy.bincount(index, weights=prices, minlength=buckets)
+        minimums = numpy.full(buckets, numpy.inf)
+        maximums = numpy.full(buckets, -numpy.inf)
+        numpy.minimum.at(minimums, index, prices)
+        numpy.maximum.at(maximums, index, prices)
+        return [(start + bucket * width, float(minimums[bucket]),
+                 float(maximums[bucket]),
+                 float(sums[bucket] / counts[bucket]))
+                for bucket in numpy.flatnonzero(counts).tolist()]
+
+    counts = [0] * buckets
+    sums = [0.0] * buckets
+    minimums = [float('inf')] * buckets
+    maximums = [float('-inf')] * buckets
+    for timestamp, price in zip(series.timestamps, series.prices):
+        bucket = min(max(int((timestamp - start) // width), 0), buckets - 1)
+        counts[bucket] += 1
+        sums[bucket] += price
+        if price < minimums[bucket]:
+            minimums[bucket] = price
+        if price > maximums[bucket]:
+            maximums[bucket] = price
+    return [(start + bucket * width, minimums[bucket], maximums[bucket],
+             sums[bucket] / counts[bucket])
+            for bucket in range(buckets) if counts[bucket]]
+
+
+def refresh_price_trend(instance_type, amazon_region, period,
+                        product_description=DEFAULT_PRODUCT_DESCRIPTION):
+    """
+    Load the price trend of the last period into price_trend_cache in the
+    background, unless it is already loading. Return the future, whose
+    result is the trend.
+    """
+    key = (amazon_region, instance_type, product_description, period)
+
+    def refresh():
+        try:
+            end_time = datetime.datetime.utcnow()
+            start_time = end_time - period
+            series = load_price_series(instance_type, amazon_region,
+                                       start_time, end_time,
+                                       product_description)
+            trend = downsample_price_series(series, _epoch(start_time),
+                                            _epoch(end_time))
+            price_trend_cache.put(key, trend)
+            return trend
+        finally:
+            with _refreshes_lock:
+                _refreshes.pop(key, None)
+
+    with _refreshes_lock:
+        future = _refreshes.get(key)
+        if future is None:
+            future = _refresh_executor.submit(
+                contextvars.copy_context().run, refresh)
+            _refreshes[key] = future
+        else:
+            increment('coalesced_calls')
+    return future
 
-    # if we found something,
-    # we get all the instance types with that price
-    prices = []
-    for instance in response['SpotPriceHistory']:
-        price = float(instance['SpotPrice'])
-        if price == minimum_price:
-            instance_type = instance['InstanceType']
-            availability_zone = instance['AvailabilityZone']
-            prices.append((instance_type, price, availability_zone))
 
-    return prices
+def get_price_trend(instance_type, amazon_region, period,
+                    product_description=DEFAULT_PRODUCT_DESCRIPTION):
+    """
+    Return the downsampled price history of the last period (a timedelta)
+    as a list of tuples [(bucket_start, min, max, mean)], None when it
+    could not be loaded within the budget of the invocation. The load goes
+    on in the background for the next question.
+    """
+    period = min(period, MAX_HISTORY_PERIOD)
+    trend = price_trend_cache.get(
+        (amazon_region, instance_type, product_description, period))
+    if trend is not None:
+        increment('cache_hits')
+        return trend
+    increment('cache_misses')
+
+    future = refresh_price_trend(instance_type, amazon_region, period,
+                                 product_description)
+    try:
+        return future.result(timeout=remaining_budget())
+    except concurrent.futures.TimeoutError:
+        increment('deadline_exceeded')
+    except RegionUnavailable as e:
+        logger.warning('%s', e)
+    except Exception as e:
+        logger.exception(e)
+    return None
+
+
+@timed
+def format_savings_answer(savings, ondemand_price, instance_type,
+                          amazon_region):
+    """
+    savings is a list of tuples [(price, availability-zone, saving)] with
+    the saving as a fraction of the on-demand price
+    Return a string
+    """
+    message = (
+        'A {} instance in {} costs *{}$* per hour on demand. With spot '
+        'instances, you save:\n'.format(
+            instance_type, amazon_region, ondemand_price)
+    )
+    return message + ''.join(
+        '*{:.0%}* in {} at {}$ per hour\n'.format(
+            saving, availability_zone, price)
+        for price, availability_zone, saving in savings)
+
+
+def format_unavailable_answer(amazon_region):
+    """
+    Return the answer when EC2 is failing in the region and there is no
+    price to answer with
+    """
+    return (
+        'Sorry, EC2 is not answering in {} at the moment. Please try again '
+        'in a minute.'.format(amazon_region)
+    )
+
+
+def format_not_loaded_answer(amazon_regions):
+    """
+    Return the answer when the prices of the regions could not be loaded
+    within the deadline
+    """
+    if all(is_region_degraded(region) for region in amazon_regions):
+        return format_unavailable_answer(', '.join(amazon_regions))
+    return (
+        'The spot prices of {} are still loading. Please ask again in a few '
+        'seconds.'.format(', '.join(amazon_regions))
+    )
+
+
+def format_age_note(age):
+    """
+    Return the note telling how old the prices of an answer are, if they
+    are not fresh (age in seconds or None)
+    """
+    if age is None:
+        return ''
+    minutes = int(age // 60)
+    return '\n_These prices are {} old._'.format(
+        '{} minutes'.format(minutes) if minutes > 1 else
+        'a minute' if minutes else 'less than a minute')
+
+
+def format_product_note(product_description):
+    """
+    Return the note telling which product the prices are for, when it is
+    not the default one
+    """
+    if product_description == DEFAULT_PRODUCT_DESCRIPTION:
+        return ''
+    return '\n_Prices for {}._'.format(product_description)
+
+
+@timed
+def format_product_prices_answer(spot_prices_results, product_descriptions,
+                                 instance_type, amazon_region):
+    """
+    spot_prices_results is a dict
+    {product_description: [(price, availability-zone)]}
+    Return a string
+    """
+    message = (
+        'The current spot prices for a {} instance in {} are:'
+        '\n'.format(instance_type, amazon_region)
+    )
+    return message + ''.join(
+        '\n{}:{}\n'.format(
+            product_description,
+            format_price_answer(spot_prices_results[product_description])
+            if spot_prices_results[product_description]
+            else '\nnot available as a spot instance')
+        for product_description in product_descriptions)
+
+
+@timed
+def format_price_answer(spot_prices):
+    """
+    Receive a list of tuples [(price, availability-zone)]
+    Return a string
+    """
+    return ''.join('\n*{}$* per hour in {}'.format(*price)
+                   for price in spot_prices)
+
+
+@timed
+def format_cheapest_answer(spot_prices_result, amazon_region, memory, cpu,
+                           ranking=None):
+    """
+    spot_prices_result is a list of tuples:
+    [(instance_type, price, availability-zone)]
+    Return a string, with the price per vCPU or GB they are ranked by
+    """
+    message = (
+        'The cheapest instances in {} with at least {} GB of memory and {} '
+        'CPUs{} are currently:\n'.format(
+            amazon_region, memory, cpu,
+            {None: '', 'cpu': ' by price per vCPU',
+             'memory': ' by price per GB'}[ranking])
+    )
+    catalog = get_catalog()
+    lines = []
+    for instance_type, price, availability_zone in spot_prices_result:
+        cores, gigabytes = catalog.resources(instance_type)
+        if ranking is None:
+            lines.append(
+                '{} at *{}$* per hour ({} vCPUs, {} GB in {})\n'.format(
+                    instance_type, price, cores, gigabytes,
+                    availability_zone))
+            continue
+        resource, unit = ((cores, 'vCPU') if ranking == 'cpu' else
+                          (gigabytes, 'GB'))
+        lines.append(
+            '{} at *{:.6f}$* per {} per hour ({}$ per hour, {} vCPUs, {} GB '
+            'in {})\n'.format(instance_type, price / resource, unit, price,
+                              cores, gigabytes, availability_zone))
+    return message + ''.join(lines)
+
+
+@timed
+def format_cheapest_anywhere_answer(cheapest, missing_regions, memory, cpu,
+                                    ranking=None):
+    """
+    cheapest is a list of tuples:
+    [(instance_type, price, availability-zone, amazon_region)]
+    Return a string
+    """
+    message = format_cheapest_answer(
+        [(instance_type, price, availability_zone)
+         for instance_type, price, availability_zone, _ in cheapest],
+        'any region', memory, cpu, ranking)
+    return message + format_missing_note(missing_regions)
+
+
+def format_missing_note(missing_regions):
+    """
+    Return the note telling which regions did not answer in time
+    """
+    if not missing_regions:
+        return ''
+    return '\n_{} did not answer in time._'.format(', '.join(missing_regions))
 
 
-def format_price_answer(spot_prices):
+@timed
+def format_cheapest_region_answer(cheapest, missing_regions, instance_type):
     """
-    Receive a list of tuples [(price, availability-zone)]
+    cheapest is a list of tuples [(price, amazon_region, availability-zone)]
+    sorted by price
     Return a string
     """
-    prices = ""
-    for price in spot_prices:
-        prices += ("\n*{}$* per hour in {}".format(*price))
-    return prices
+    message = (
+        'The cheapest region for a {} instance is currently {} at *{}$* per '
+        'hour in {}.'.format(instance_type, cheapest[0][1], cheapest[0][0],
+                             cheapest[0][2])
+    )
+    if len(cheapest) > 1:
+        message += '\nThe other regions are:\n' + ''.join(
+            '{} at {}$ per hour in {}\n'.format(region, price, zone)
+            for price, region, zone in cheapest[1:])
+    return message + format_missing_note(missing_regions)
 
 
-def format_cheapest_answer(spot_prices_result, amazon_region, memory, cpu):
+@timed
+def format_price_trend_answer(trend, instance_type, amazon_region, period):
     """
-    spot_prices_result is a list of tuples:
-    [(instance_type, price, availability-zone)]
+    trend is a list of tuples [(bucket_start, min, max, mean)]
     Return a string
     """
     message = (
-        'The cheapest instances in {} with at least {} GB of memory and {} '
-        'CPUs are currently at *{}$* per hour. The instance types are:'
-        '\n'.format(amazon_region, memory, cpu, spot_prices_result[0][1])
+        'The spot price of a {} instance in {} over the last {} was between '
+        '*{}$* and *{}$* per hour:\n'.format(
+            instance_type, amazon_region, format_period(period),
+            min(bucket[1] for bucket in trend),
+            max(bucket[2] for bucket in trend))
     )
-    instances = ""
-    for instance in spot_prices_result:
-        instance_type = instance[0]
-        availability_zone = instance[2]
-        cores, memory = INSTANCE_TYPES.get(instance_type)
-        instances += (
-            '{} ({} vCPUs, {} GB in {})'
-            '\n'.format(instance_type, cores, memory, availability_zone)
-        )
-    message += instances
+    message += ''.join(
+        '{:%b %d %H:%M}: {:.4f}$ to {:.4f}$ (mean {:.4f}$)\n'.format(
+            datetime.datetime.fromtimestamp(bucket_start,
+                                            datetime.timezone.utc),
+            minimum, maximum, mean)
+        for bucket_start, minimum, maximum, mean in trend)
     return message
 
 
+@timed
 def format_instance_types_answer(instances, memory, cpu):
     """
     We receive a list of instances and
@@ -360,17 +3092,49 @@ def format_instance_types_answer(instances, memory, cpu):
         'The instance types with at least {} GB of memory and {} CPUs are: '
         '\n'.format(memory, cpu)
     )
-    formatted_instances = ''
-    # we sort the instance types for more readability
-    instances.sort()
-    for instance in instances:
-        cores, memory = INSTANCE_TYPES.get(instance)
-        formatted_instances += (
-            '{} ({} vCPUs, {} GB) \n'.format(instance, cores, memory))
-    message += formatted_instances
+    catalog = get_catalog()
+    # the instance types are already sorted for more readability
+    return message + ''.join(
+        '{} ({} vCPUs, {} GB) \n'.format(instance,
+                                         *catalog.resources(instance))
+        for instance in instances)
+
+
+@timed
+def format_watch_answer(watched, amazon_region, max_price, cheapest):
+    """
+    watched describes the instance types of the watch, cheapest is a list
+    of tuples [(instance_type, price, availability-zone)] of the current
+    cheapest of them
+    Return a string
+    """
+    message = (
+        'I will let you know when {} is under *{}$* per hour in {}.'.format(
+            watched, max_price, amazon_region)
+    )
+    if cheapest and cheapest[0][1] <= max_price:
+        message += (
+            '\nIt already is: {} at *{}$* per hour in {}.'.format(*cheapest[0])
+        )
+    elif cheapest:
+        message += (
+            '\nThe cheapest is currently {} at *{}$* per hour in {}.'.format(
+                *cheapest[0])
+        )
     return message
 
 
+def format_alerts_note(alerts):
+    """
+    Return the note telling the price alerts of the user
+    [(instance_type, region, price, availability-zone)]
+    """
+    return ''.join(
+        '\n_Price alert: {} is at {}$ per hour in {}._'.format(
+            instance_type, price, availability_zone)
+        for instance_type, _, price, availability_zone in alerts)
+
+
 """ --- Functions that control the bot's behavior --- """
 
 
@@ -378,7 +3142,7 @@ def get_current_spot_price(intent_request):
     """
     Performs dialog management and fulfillment for getting current spot price.
     """
-    logger.debug('Current Intent: {}'.format(intent_request['currentIntent']))
+    logger.debug('Current Intent: %s', intent_request['currentIntent'])
     current = intent_request.get('currentIntent')
     slots = current.get('slots') if current else None
     instance_type = slots.get('InstanceType') if slots else None
@@ -408,13 +3172,32 @@ def get_current_spot_price(intent_request):
 
     # Display value. Call backend
     # We get the info and we format the answer
-    spot_prices_result = get_price_history([instance_type], amazon_region)
-    spot_prices_message = format_price_answer(spot_prices_result)
+    product_descriptions = get_product_descriptions(slots)
+    spot_prices_results = get_price_history_by_product(
+        [instance_type], amazon_region, product_descriptions)
 
-    message = (
-        'The current spot price for a {} instance in {} is {}'
-        '.'.format(instance_type, amazon_region, spot_prices_message)
-    )
+    if None in spot_prices_results.values():
+        message = format_not_loaded_answer([amazon_region])
+    elif not any(spot_prices_results.values()):
+        message = (
+            '{} is not available as a spot instance in {}.'.format(
+                instance_type, amazon_region)
+        )
+    elif len(product_descriptions) == 1:
+        spot_prices_message = format_price_answer(
+            spot_prices_results[product_descriptions[0]])
+        message = (
+            'The current spot price for a {} instance in {} is {}'
+            '.'.format(instance_type, amazon_region, spot_prices_message)
+        )
+        message += format_product_note(product_descriptions[0])
+    else:
+        message = format_product_prices_answer(
+            spot_prices_results, product_descriptions, instance_type,
+            amazon_region)
+    message += format_age_note(max(
+        get_snapshot_age(amazon_region, product_description) or 0
+        for product_description in product_descriptions) or None)
     logger.debug(message)
     return close(
         session_attributes,
@@ -431,7 +3214,7 @@ def get_cheapest_spot_price(intent_request):
     Performs dialog management and fulfillment for getting cheapest spot
     instance given a minimum memory and CPU.
     """
-    logger.debug('Current Intent: {}'.format(intent_request['currentIntent']))
+    logger.debug('Current Intent: %s', intent_request['currentIntent'])
     current = intent_request.get('currentIntent')
     slots = current.get('slots') if current else None
     amazon_region = slots.get('AmazonRegion') if slots else None
@@ -464,31 +3247,56 @@ def get_cheapest_spot_price(intent_request):
     # first we format the inputs
     cpu = slots.get('CPUs') if slots.get('CPUs') else '1'
 
-    if not slots.get('Memory') or not slots.get('Memory')[0].isdigit():
-        memory = '0'
-    else:
-        # we transform the memory into digits only
-        if slots.get('Memory').isdigit():
-            memory = slots.get('Memory')
+    memory = parse_memory(slots.get('Memory'))
+
+    product_description = get_product_descriptions(slots)[0]
+    ranking = get_ranking(slots)
+    if is_any_region(amazon_region):
+        cheapest, missing_regions = get_cheapest_anywhere(
+            cpu, memory, product_description, ranking)
+        if not cheapest and missing_regions:
+            message = format_not_loaded_answer(missing_regions)
+        elif not cheapest:
+            message = (
+                "Sorry, we couldn't find instances available in any region "
+                "with at least {} GB of memory and {} CPUs.".format(
+                    memory, cpu)
+            )
         else:
-            memory = ''
-            for c in slots.get('Memory'):
-                if c.isdigit():
-                    memory += str(c)
-                else:
-                    break
+            message = format_cheapest_anywhere_answer(
+                cheapest, missing_regions, memory, cpu, ranking)
+            message += format_product_note(product_description)
+            ages = [get_snapshot_age(region, product_description)
+                    for region in set(row[3] for row in cheapest)]
+            message += format_age_note(max(age or 0 for age in ages) or None)
+        logger.debug(message)
+        return close(
+            session_attributes,
+            'Fulfilled',
+            {
+                'contentType': 'PlainText',
+                'content': message
+            }
+        )
 
-    instances = get_instances(cpu, memory)
-    spot_prices_result = get_cheapest_instance(instances, amazon_region)
+    spot_prices_result = get_cheapest_with_at_least(cpu, memory,
+                                                    amazon_region,
+                                                    product_description,
+                                                    ranking)
 
-    if not spot_prices_result:
+    if spot_prices_result is None:
+        message = format_not_loaded_answer([amazon_region])
+    elif not spot_prices_result:
         message = (
             "Sorry, we couldn't find instances available in {} with at least "
             "{} GB of memory and {} CPUs.".format(amazon_region, memory, cpu)
         )
     else:
         message = format_cheapest_answer(spot_prices_result, amazon_region,
-                                         memory, cpu)
+                                         memory, cpu, ranking)
+        message += format_product_note(product_description)
+        message += format_age_note(get_snapshot_age(amazon_region,
+                                                    product_description))
 
     logger.debug(message)
     return close(
@@ -506,7 +3314,7 @@ def get_instance_types(intent_request):
     Performs dialog management and fulfillment for getting instance
     types given a minimum memory and CPU.
     """
-    logger.debug('Current Intent: {}'.format(intent_request['currentIntent']))
+    logger.debug('Current Intent: %s', intent_request['currentIntent'])
     current = intent_request.get('currentIntent')
     slots = current.get('slots') if current else None
     if intent_request.get('sessionAttributes'):
@@ -536,22 +3344,20 @@ def get_instance_types(intent_request):
     # We get the info and we format the answer
 
     # first we format the inputs
-    cpu = slots.get('CPUs') if slots.get('CPUs') else '1'
+    cpu = slots.get('CPUs').strip() if slots.get('CPUs') else '1'
+    memory = parse_memory(slots.get('Memory'))
 
-    if not slots.get('Memory') or not slots.get('Memory')[0].isdigit():
-        memory = '0'
-    else:
-        # we transform the memory into digits only
-        if slots.get('Memory').isdigit():
-            memory = slots.get('Memory')
-        else:
-            memory = ''
-            for c in slots.get('Memory'):
-                if c.isdigit():
-                    memory += str(c)
-                else:
-                    break
+    response = instance_types_response(cpu, memory, get_catalog().version)
+    return dict(response, sessionAttributes=session_attributes)
 
+
+@functools.lru_cache(maxsize=RESPONSE_CACHE_SIZE)
+def instance_types_response(cpu, memory, catalog_version):
+    """
+    Return the response to GetInstanceTypes, without session attributes.
+    The answer only depends on the slots and the catalog, so the responses
+    are kept for the next questions, and must not be modified.
+    """
     instances = get_instances(cpu, memory)
 
     if not instances:
@@ -562,6 +3368,281 @@ def get_instance_types(intent_request):
     else:
         message = format_instance_types_answer(instances, memory, cpu)
 
+    logger.debug(message)
+    return close(
+        None,
+        'Fulfilled',
+        {
+            'contentType': 'PlainText',
+            'content': message
+        }
+    )
+
+
+def get_cheapest_region_for_instance_type(intent_request):
+    """
+    Performs dialog management and fulfillment for getting the region where
+    an instance type is the cheapest.
+    """
+    logger.debug('Current Intent: %s', intent_request['currentIntent'])
+    current = intent_request.get('currentIntent')
+    slots = current.get('slots') if current else None
+    instance_type = slots.get('InstanceType') if slots else None
+    if intent_request.get('sessionAttributes'):
+        session_attributes = intent_request['sessionAttributes']
+    else:
+        session_attributes = {}
+
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        # Validate any slots which have been specified.  If any are invalid,
+        # re-elicit for their value
+        validation_result = validate_get_cheapest_region(slots)
+        if not validation_result['isValid']:
+            slots[validation_result['violatedSlot']] = None
+            return elicit_slot(
+                session_attributes,
+                current['name'],
+                slots,
+                validation_result['violatedSlot'],
+                validation_result['message']
+            )
+
+        # Otherwise, let native DM rules determine how to elicit for slots
+        # and/or drive confirmation.
+        return delegate(session_attributes, slots)
+
+    # Display value. Call backend
+    # We get the info and we format the answer
+    product_description = get_product_descriptions(slots)[0]
+    cheapest, missing_regions = get_cheapest_region(
+        instance_type, product_description=product_description)
+
+    if not cheapest and missing_regions:
+        message = format_not_loaded_answer(missing_regions)
+    elif not cheapest:
+        message = (
+            "Sorry, we couldn't find any region where {} is available as a "
+            "spot instance.".format(instance_type)
+        )
+    else:
+        message = format_cheapest_region_answer(cheapest, missing_regions,
+                                                instance_type)
+        message += format_product_note(product_description)
+        ages = [get_snapshot_age(region, product_description)
+                for _, region, _ in cheapest]
+        message += format_age_note(max(age or 0 for age in ages) or None)
+
+    logger.debug(message)
+    return close(
+        session_attributes,
+        'Fulfilled',
+        {
+            'contentType': 'PlainText',
+            'content': message
+        }
+    )
+
+
+def get_spot_price_history(intent_request):
+    """
+    Performs dialog management and fulfillment for getting the price
+    history of an instance type.
+    """
+    logger.debug('Current Intent: %s', intent_request['currentIntent'])
+    current = intent_request.get('currentIntent')
+    slots = current.get('slots') if current else None
+    instance_type = slots.get('InstanceType') if slots else None
+    amazon_region = slots.get('AmazonRegion') if slots else None
+    if intent_request.get('sessionAttributes'):
+        session_attributes = intent_request['sessionAttributes']
+    else:
+        session_attributes = {}
+
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        # Validate any slots which have been specified.  If any are invalid,
+        # re-elicit for their value
+        validation_result = validate_get_price_history(slots)
+        if not validation_result['isValid']:
+            slots[validation_result['violatedSlot']] = None
+            return elicit_slot(
+                session_attributes,
+                current['name'],
+                slots,
+                validation_result['violatedSlot'],
+                validation_result['message']
+            )
+
+        # Otherwise, let native DM rules determine how to elicit for slots
+        # and/or drive confirmation.
+        return delegate(session_attributes, slots)
+
+    # Display value. Call backend
+    # We get the info and we format the answer
+    period = parse_period(slots.get('Period')) or DEFAULT_HISTORY_PERIOD
+    period = min(period, MAX_HISTORY_PERIOD)
+    product_description = get_product_descriptions(slots)[0]
+    trend = get_price_trend(instance_type, amazon_region, period,
+                            product_description)
+
+    if trend is None:
+        message = format_not_loaded_answer([amazon_region])
+    elif not trend:
+        message = (
+            "Sorry, we couldn't find any price for {} in {} over the last {}"
+            ".".format(instance_type, amazon_region, format_period(period))
+        )
+    else:
+        message = format_price_trend_answer(trend, instance_type,
+                                            amazon_region, period)
+        message += format_product_note(product_description)
+
+    logger.debug(message)
+    return close(
+        session_attributes,
+        'Fulfilled',
+        {
+            'contentType': 'PlainText',
+            'content': message
+        }
+    )
+
+
+def get_spot_savings(intent_request):
+    """
+    Performs dialog management and fulfillment for comparing the spot
+    prices of an instance type with its on-demand price.
+    """
+    logger.debug('Current Intent: %s', intent_request['currentIntent'])
+    current = intent_request.get('currentIntent')
+    slots = current.get('slots') if current else None
+    instance_type = slots.get('InstanceType') if slots else None
+    amazon_region = slots.get('AmazonRegion') if slots else None
+    if intent_request.get('sessionAttributes'):
+        session_attributes = intent_request['sessionAttributes']
+    else:
+        session_attributes = {}
+
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        # Validate any slots which have been specified.  If any are invalid,
+        # re-elicit for their value
+        validation_result = validate_get_spot_savings(slots)
+        if not validation_result['isValid']:
+            slots[validation_result['violatedSlot']] = None
+            return elicit_slot(
+                session_attributes,
+                current['name'],
+                slots,
+                validation_result['violatedSlot'],
+                validation_result['message']
+            )
+
+        # Otherwise, let native DM rules determine how to elicit for slots
+        # and/or drive confirmation.
+        return delegate(session_attributes, slots)
+
+    # Display value. Call backend
+    # We get the info and we format the answer
+    ondemand_prices = get_ondemand_prices()
+    ondemand_price = (ondemand_prices.get(amazon_region, instance_type)
+                      if ondemand_prices is not None else None)
+    # EC2 is only called when there is an on-demand price to compare with
+    spot_prices = (get_price_history([instance_type], amazon_region)
+                   if ondemand_price is not None else None)
+
+    if ondemand_price is None:
+        message = (
+            'Sorry, I do not know the on-demand price of {} in {}.'.format(
+                instance_type, amazon_region)
+        )
+    elif spot_prices is None:
+        message = format_not_loaded_answer([amazon_region])
+    elif not spot_prices:
+        message = (
+            '{} is not available as a spot instance in {}. It costs *{}$* '
+            'per hour on demand.'.format(instance_type, amazon_region,
+                                         ondemand_price)
+        )
+    else:
+        savings = [(price, availability_zone, 1 - price / ondemand_price)
+                   for price, availability_zone in spot_prices]
+        message = format_savings_answer(savings, ondemand_price,
+                                        instance_type, amazon_region)
+        message += format_age_note(get_snapshot_age(amazon_region))
+
+    logger.debug(message)
+    return close(
+        session_attributes,
+        'Fulfilled',
+        {
+            'contentType': 'PlainText',
+            'content': message
+        }
+    )
+
+
+def watch_spot_price(intent_request):
+    """
+    Performs dialog management and fulfillment for watching the price of
+    an instance type, or of the instances with at least a CPU and memory.
+    """
+    logger.debug('Current Intent: %s', intent_request['currentIntent'])
+    current = intent_request.get('currentIntent')
+    slots = current.get('slots') if current else None
+    instance_type = slots.get('InstanceType') if slots else None
+    amazon_region = slots.get('AmazonRegion') if slots else None
+    if intent_request.get('sessionAttributes'):
+        session_attributes = intent_request['sessionAttributes']
+    else:
+        session_attributes = {}
+
+    if intent_request['invocationSource'] == 'DialogCodeHook':
+        # Validate any slots which have been specified.  If any are invalid,
+        # re-elicit for their value
+        validation_result = validate_watch_spot_price(slots)
+        if not validation_result['isValid']:
+            slots[validation_result['violatedSlot']] = None
+            return elicit_slot(
+                session_attributes,
+                current['name'],
+                slots,
+                validation_result['violatedSlot'],
+                validation_result['message']
+            )
+
+        # Otherwise, let native DM rules determine how to elicit for slots
+        # and/or drive confirmation.
+        return delegate(session_attributes, slots)
+
+    # Display value. Call backend
+    # We get the info and we format the answer
+    max_price = parse_price(slots.get('MaxPrice'))
+    product_description = get_product_descriptions(slots)[0]
+    if instance_type:
+        instances = [instance_type]
+        watched = 'a {} instance'.format(instance_type)
+    else:
+        cpu = slots.get('CPUs') if slots.get('CPUs') else '1'
+        memory = parse_memory(slots.get('Memory'))
+        instances = get_instances(cpu, memory)
+        watched = (
+            'an instance with at least {} GB of memory and {} CPUs'.format(
+                memory, cpu)
+        )
+
+    if not instances:
+        message = (
+            "Sorry, we couldn't find instances available as {}.".format(
+                watched)
+        )
+    else:
+        watch_store.add(intent_request['userId'], amazon_region,
+                        product_description, instances, max_price)
+        cheapest = get_cheapest_instance(instances, amazon_region,
+                                         product_description, top=1)
+        message = format_watch_answer(watched, amazon_region, max_price,
+                                      cheapest)
+        message += format_product_note(product_description)
+
     logger.debug(message)
     return close(
         session_attributes,
@@ -575,6 +3656,7 @@ def get_instance_types(intent_request):
 # --- Intents ---
 
 
+@timed
 def dispatch(intent_request):
     """
     Called when the user specifies an intent for this bot.
@@ -582,12 +3664,10 @@ def dispatch(intent_request):
 
     user_id = intent_request['userId']
     intent_name = intent_request['currentIntent']['name']
-    log_message = (
-        'dispatch userId={}, intentName={}'.format(user_id, intent_name)
-    )
-    logger.debug(log_message)
+    logger.debug('dispatch userId=%s, intentName=%s', user_id, intent_name)
 
     intent_name = intent_request['currentIntent']['name']
+    normalize_slots(intent_request['currentIntent'].get('slots'))
 
     # Dispatch to your bot's intent handlers
     if intent_name == 'GetCurrentSpotInstancePrice':
@@ -596,6 +3676,14 @@ def dispatch(intent_request):
         return get_cheapest_spot_price(intent_request)
     elif intent_name == 'GetInstanceTypes':
         return get_instance_types(intent_request)
+    elif intent_name == 'GetCheapestRegionForInstanceType':
+        return get_cheapest_region_for_instance_type(intent_request)
+    elif intent_name == 'GetSpotPriceHistory':
+        return get_spot_price_history(intent_request)
+    elif intent_name == 'WatchSpotPrice':
+        return watch_spot_price(intent_request)
+    elif intent_name == 'GetSpotSavings':
+        return get_spot_savings(intent_request)
 
     raise Exception('Intent with name ' + intent_name + ' not supported')
 
@@ -608,6 +3696,188 @@ def lambda_handler(event, context):
     Route the incoming request based on intent.
     The JSON body of the request is provided in the event slot.
     """
-    logger.debug('event.bot.name={}'.format(event['bot']['name']))
+    logger.debug('event.bot.name=%s', event['bot']['name'])
+
+    metrics = InvocationMetrics()
+    metrics_token = _current_metrics.set(metrics)
+    deadline_token = _current_deadline.set(get_deadline(context))
+    stale_token = _current_stale.set({})
+    try:
+        with (profiled(event, context) if should_profile(event)
+              else contextlib.nullcontext()):
+            response = dispatch(event)
+        response = add_alerts(response, event['userId'])
+    finally:
+        _current_stale.reset(stale_token)
+        _current_deadline.reset(deadline_token)
+        _current_metrics.reset(metrics_token)
+        emit_metrics(metrics, event)
+    if not INIT_STATS['reported']:
+        report_init_stats()
+    return response
+
+
+def get_backend_needs(intent_request):
+    """
+    Return the set of the (amazon_region, product_description) whose
+    current spot prices the fulfillment of the intent needs
+    """
+    if intent_request.get('invocationSource') != 'FulfillmentCodeHook':
+        return set()
+    intent_name = intent_request['currentIntent']['name']
+    slots = intent_request['currentIntent']['slots'] or {}
+    # dispatch would correct them the same way
+    normalize_slots(slots)
+    product_descriptions = get_product_descriptions(slots)
+
+    if intent_name == 'GetCheapestRegionForInstanceType':
+        info = get_catalog().get(slots.get('InstanceType') or '')
+        amazon_regions = info.regions if info else ()
+    elif intent_name in ('GetCheapestSpotInstancesWithAtLeast',
+                         'WatchSpotPrice'):
+        amazon_regions = [slots.get('AmazonRegion')]
+        if (intent_name == 'GetCheapestSpotInstancesWithAtLeast' and
+                is_any_region(amazon_regions[0])):
+            amazon_regions = get_catalog().regions
+        product_descriptions = product_descriptions[:1]
+    elif intent_name in ('GetCurrentSpotInstancePrice', 'GetSpotSavings'):
+        amazon_regions = [slots.get('AmazonRegion')]
+    else:
+        # the history is queried per instance type, GetInstanceTypes never
+        # calls AWS
+        return set()
+    return {(amazon_region, product_description)
+            for amazon_region in amazon_regions
+            if amazon_region and isvalid_amazon_region(amazon_region)
+            for product_description in product_descriptions}
+
+
+def batch_handler(event, context):
+    """
+    Answer a list of Lex events {"events": [...]}. The spot prices they
+    need are loaded first, with a single request per region, then each
+    event is answered by lambda_handler from the cache.
+    Return the list of the responses.
+    """
+    events = (event or {}).get('events') or []
+    needs = collections.defaultdict(set)
+    for intent_request in events:
+        for amazon_region, product_description in get_backend_needs(
+                intent_request):
+            needs[amazon_region].add(product_description)
+
+    def preload(amazon_region, product_descriptions, deadline):
+        _current_deadline.set(deadline)
+        return get_region_snapshots(amazon_region, product_descriptions)
+
+    deadline = get_deadline(context)
+    futures = [
+        _region_executor.submit(contextvars.copy_context().run, preload,
+                                amazon_region, sorted(product_descriptions),
+                                deadline)
+        for amazon_region, product_descriptions in needs.items()
+    ]
+    # get_region_snapshots gives up by itself at the deadline
+    concurrent.futures.wait(futures)
+    logger.info('batch events=%s regions=%s', len(events), len(needs))
+
+    return [lambda_handler(intent_request, context)
+            for intent_request in events]
+
+
+def add_alerts(response, user_id):
+    """
+    Return the response with the price alerts of the user added to its
+    message, if it closes the intent. It costs a SQLite transaction per
+    answer once the watch store exists.
+    """
+    dialog_action = response['dialogAction']
+    if dialog_action['type'] != 'Close':
+        return response
+    alerts = watch_store.pop_alerts(user_id)
+    if not alerts:
+        return response
+    # the responses of pure intents are memoized, they are copied
+    message = dict(dialog_action['message'])
+    message['content'] += format_alerts_note(alerts)
+    return dict(response, dialogAction=dict(dialog_action, message=message))
+
+
+def prewarm_handler(event, context):
+    """
+    Scheduled entry point: load the snapshots of every region and store
+    them with the cheapest instances for PRECOMPUTED_THRESHOLDS, then
+    evaluate the watches against them.
+    The event may restrict the regions with {"regions": [...]}.
+    """
+    amazon_regions = (event or {}).get('regions') or get_catalog().regions
+    product_descriptions = sorted(
+        {DEFAULT_PRODUCT_DESCRIPTION} | watch_store.products())
+    futures = {
+        _region_executor.submit(load_region_snapshots, region,
+                                product_descriptions): region
+        for region in amazon_regions
+    }
+
+    failed = []
+    alerts = []
+    for future in concurrent.futures.as_completed(futures):
+        region = futures[future]
+        snapshots = future.result()
+        if snapshots is None:
+            failed.append(region)
+            continue
+        for snapshot in snapshots.values():
+            spot_price_cache.put((region, snapshot.product_description),
+                                 snapshot, snapshot.fetched_at)
+            cheapest = {
+                (cpu, memory): [instance[:3] for instance in
+                                snapshot.matrix.cheapest(cpu, memory)]
+                for cpu, memory in PRECOMPUTED_THRESHOLDS
+            }
+            price_store.write(snapshot, cheapest)
+            alerts.extend(watch_store.evaluate(snapshot))
+    watch_store.expire()
+
+    logger.info('prewarm regions=%s failed=%s alerts=%s',
+                len(amazon_regions), sorted(failed), len(alerts))
+    return {'regions': len(amazon_regions) - len(failed),
+            'failed': sorted(failed), 'alerts': len(alerts)}
+
+
+def get_deadline(context):
+    """
+    Return the time.monotonic() by which the answer must be ready: within
+    LEX_DEADLINE_MS, and before the Lambda times out
+    """
+    budget_ms = LEX_DEADLINE_MS
+    if context is not None:
+        budget_ms = min(budget_ms, context.get_remaining_time_in_millis())
+    return time.monotonic() + max(budget_ms - DEADLINE_MARGIN_MS, 0) / 1000.0
+
+
+def emit_metrics(metrics, event):
+    """
+    Print the metrics of the invocation as a single JSON line, which
+    CloudWatch turns into metrics
+    """
+    dimensions = {
+        'Intent': (event.get('currentIntent') or {}).get('name', 'Unknown'),
+        'InvocationSource': event.get('invocationSource', 'Unknown'),
+    }
+    print(json.dumps(metrics.to_emf(dimensions), sort_keys=True))
+
+
+def report_init_stats():
+    """
+    Log the module setup time and the deferred imports of the cold start,
+    once the first invocation has run
+    """
+    INIT_STATS['reported'] = True
+    logger.info(json.dumps({'metric': 'cold_start',
+                            'setup_ms': INIT_STATS['setup_ms'],
+                            'imports_ms': INIT_STATS['imports_ms']},
+                           sort_keys=True))
+
 
-    return dispatch(event)
+INIT_STATS['setup_ms'] = round((time.perf_counter() - _init_started) * 1000, 2)
@@ -0,0 +1,211 @@
+# Copyright (c) 2017 Sandtable Ltd. All rights reserved.
+
+"""
+HTTP server answering Lex events outside of Lambda.
+
+POST a Lex event as JSON to / and the response of lambda_handler comes
+back as JSON. Requests are served concurrently by asyncio, and the
+intents run in a bounded pool of threads, since boto3 calls block. All
+the requests share the spot price cache and the EC2 clients of the
+process, which stay warm between questions.
+
+GET /health answers {"status": "ok"} with the size of the cache.
+
+Usage: python server.py [--port 8080] [--workers 32] [--prewarm 60]
+
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+
+import lambda_function
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+def is_lex_event(event):
+    """
+    Return True when the event has the fields that lambda_handler reads
+    """
+    return (isinstance(event, dict) and
+            isinstance(event.get('currentIntent'), dict) and
+            'name' in event['currentIntent'] and
+            isinstance(event.get('bot'), dict) and 'name' in event['bot'] and
+            'userId' in event and 'invocationSource' in event)
+
+
+class Server(object):
+    """
+    Answer Lex events over HTTP/1.1 with keep-alive, running at most
+    `workers` intents at once
+    """
+
+    def __init__(self, workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='sbot')
+        # requests beyond the pool wait here rather than in its queue
+        self.slots = asyncio.Semaphore(workers)
+
+    async def answer(self, event):
+        loop = asyncio.get_running_loop()
+        async with self.slots:
+            # dispatch is the same as in Lambda, without a Lambda context
+            # the answer is ready within LEX_DEADLINE_MS
+            return await loop.run_in_executor(
+                self.executor, lambda_function.lambda_handler, event, None)
+
+    async def route(self, method, path, body):
+        if path == '/health':
+            return {'status': 'ok',
+                    'cache': len(lambda_function.spot_price_cache)}
+        if path != '/':
+            raise HttpError(404, 'Unknown path {}'.format(path))
+        if method != 'POST':
+            raise HttpError(405, 'Lex events must be POSTed')
+        try:
+            event = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise HttpError(400, 'The body is not JSON')
+        if not is_lex_event(event):
+            raise HttpError(400, 'The body is not a Lex event')
+        return await self.answer(event)
+
+    async def read_request(self, reader):
+        """
+        Return the tuple (method, path, headers, body), None when the
+        client closed the connection
+        """
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, path, _ = request_line.decode('latin-1').split()
+        except ValueError:
+            raise HttpError(400, 'Malformed request line')
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HttpError(400, 'Malformed Content-Length')
+        if length < 0:
+            raise HttpError(400, 'Malformed Content-Length')
+        if length > MAX_BODY_SIZE:
+            raise HttpError(413, 'The body is too large')
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), path.split('?')[0], headers, body
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    keep_alive = headers.get('connection') != 'close'
+                    status, payload = 200, await self.route(method, path,
+                                                            body)
+                except HttpError as e:
+                    status, payload = e.status, {'error': str(e)}
+                except Exception as e:
+                    logger.exception(e)
+                    status, payload = 500, {'error': 'Internal error'}
+
+                content = json.dumps(payload).encode('utf-8')
+                writer.write(
+                    'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                    'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                        status, REASONS[status], len(content),
+                        'keep-alive' if keep_alive else 'close'
+                    ).encode('latin-1') + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def prewarm(self, interval):
+        """
+        Run prewarm_handler every interval seconds, in place of the
+        scheduled event of Lambda
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(
+                    self.executor, lambda_function.prewarm_handler, {}, None)
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(interval)
+
+
+async def serve(host, port, workers, prewarm_interval):
+    server = Server(workers)
+    # the event loop only keeps a weak reference to its tasks
+    prewarm_task = None
+    if prewarm_interval:
+        prewarm_task = asyncio.ensure_future(server.prewarm(prewarm_interval))
+    http_server = await asyncio.start_server(server.handle_connection, host,
+                                             port)
+    logger.info('listening on %s:%s with %s workers', host, port, workers)
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        if prewarm_task is not None:
+            prewarm_task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=32,
+                        help='intents answered at once (default: '
+                             '%(default)s)')
+    parser.add_argument('--prewarm', type=float, default=0,
+                        help='seconds between two prewarms of the prices, '
+                             '0 to disable (default: %(default)s)')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    # every worker may use the EC2 client of the same region at once
+    lambda_function.EC2_CLIENT_OPTIONS['max_pool_connections'] = max(
+        lambda_function.EC2_CLIENT_OPTIONS['max_pool_connections'],
+        args.workers)
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers, args.prewarm))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()